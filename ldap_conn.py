@@ -9,12 +9,14 @@ __status__ = "Production"
 try:
     import ldap
     from ldap.filter import escape_filter_chars
+    from ldap.controls import SimplePagedResultsControl
 except ImportError:
     print("ldap module is missing! please install it and re-run")
     print("you can install it by running # pip install python-ldap")
 
 import os
 import sys
+import time
 import logging
 from utils import cleanup, config, log_abu_settings
 
@@ -38,6 +40,13 @@ EVENT_TYPE = {
 ERR_TEMPLATE = "An exception of type {0} occurred. Arguments:\n{1!r}"
 
 
+def error_message(e):
+    log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
+    if e.args and isinstance(e.args[0], dict):
+        return f"{e.args[0].get('desc')}, More Info: {e.args[0].get('info')}"
+    return str(e)
+
+
 class LdapClient:
     """Ldap Client"""
 
@@ -101,6 +110,54 @@ class LdapClient:
             err_m = f"{e.args[0].get('desc')}, More Info: {e.args[0].get('info')}"
             log.error(f"Problem while modifying record: {err_m}")
             
+    def modify_many(self, entries, max_inflight=50, timeout=30):
+        """
+        Apply many modifications, entries being (dn, [(event_type, attr_name,
+        attr_value), ...]) pairs. All the changes of a dn go in one modify
+        request, and up to max_inflight requests are pipelined on the
+        connection. attr_value can be str, bytes, a list of them, or None
+        (DELETE of the whole attribute). Returns a report with succeeded,
+        failed, seconds and results ({dn: {"ok": bool, "error": str}}).
+        """
+        modlists = {}
+        for dn, changes in entries:
+            modlist = modlists.setdefault(dn, [])
+            for event_type, attr_name, attr_value in changes:
+                try:
+                    operation = EVENT_TYPE[event_type]
+                except KeyError:
+                    raise ValueError(f"Event type can be only {EVENT_TYPE.keys()}")
+                if attr_value is not None:
+                    if not isinstance(attr_value, (list, tuple)):
+                        attr_value = [attr_value]
+                    attr_value = [
+                        value.encode("utf-8") if isinstance(value, str) else value
+                        for value in attr_value
+                    ]
+                modlist.append((operation, attr_name, attr_value))
+        log.info(f"Modifing {len(modlists)} records on ldap, {max_inflight} at a time")
+
+        results = {}
+        started = time.perf_counter()
+        for dn, _, error in self._pipeline(
+            modlists, lambda dn: self._conn.modify_ext(dn, modlists[dn]), max_inflight, timeout
+        ):
+            if error is not None:
+                log.error(f"Problem while modifying record {dn}: {error}")
+            results[dn] = {"ok": error is None, "error": error}
+
+        report = {
+            "succeeded": sum(1 for result in results.values() if result["ok"]),
+            "failed": sum(1 for result in results.values() if not result["ok"]),
+            "seconds": time.perf_counter() - started,
+            "results": {dn: results[dn] for dn in modlists},
+        }
+        log.warning(
+            f"Modifing records completed: {report['succeeded']} succeeded, "
+            f"{report['failed']} failed in {report['seconds']:.2f}s"
+        )
+        return report
+
     def search(
         self, basedn, object_to_search, attributes_to_search, escape_wildchar=True
     ):
@@ -129,6 +186,206 @@ class LdapClient:
             log.error(f"Problem while searching: {err_m}")
             return False
 
+    def search_paged(
+        self,
+        basedn,
+        object_to_search,
+        attributes_to_search,
+        page_size=1000,
+        max_results=None,
+        pages=False,
+        escape_wildchar=True,
+    ):
+        """
+        Generator over the search results, fetched page_size entries at a time
+        with the Simple Paged Results control, so the server size limit is not
+        hit and only one page is held in memory. Yields (dn, attrs) entries as
+        they arrive, or one list per page with pages=True, and stops after
+        max_results entries. Errors are logged and raised.
+        """
+        if escape_wildchar:
+            object_to_search = escape_filter_chars(object_to_search)
+
+        log.info(f"Paged search of {object_to_search}, {page_size} entries per page")
+        control = SimplePagedResultsControl(True, size=page_size, cookie="")
+        msgid = None
+        returned = 0
+        try:
+            while True:
+                msgid = self._conn.search_ext(
+                    basedn,
+                    ldap.SCOPE_SUBTREE,
+                    object_to_search,
+                    attributes_to_search,
+                    serverctrls=[control],
+                )
+                page = []
+                while True:
+                    rtype, rdata, _, rctrls = self._conn.result3(msgid, all=0)
+                    if rtype == ldap.RES_SEARCH_RESULT:
+                        msgid = None
+                        break
+                    if rtype != ldap.RES_SEARCH_ENTRY:
+                        # search references
+                        continue
+                    for entry in rdata:
+                        returned += 1
+                        if pages:
+                            page.append(entry)
+                        else:
+                            yield entry
+                        if max_results is not None and returned >= max_results:
+                            log.info(f"Paged search stopped at max_results={max_results}")
+                            if page:
+                                yield page
+                            return
+
+                control.cookie = next(
+                    (
+                        ctrl.cookie
+                        for ctrl in rctrls
+                        if ctrl.controlType == SimplePagedResultsControl.controlType
+                    ),
+                    b"",
+                )
+                if page:
+                    yield page
+                if not control.cookie:
+                    break
+            log.debug(f"Paged search completed successfully, {returned} entries")
+        except ldap.LDAPError as e:
+            log.error(f"Problem while searching: {error_message(e)}")
+            raise
+        finally:
+            # stopped early: let the server drop the search state
+            if msgid is not None:
+                self._abandon(msgid)
+            elif control.cookie:
+                self._release_paged_search(basedn, object_to_search, control.cookie)
+
+    def _pipeline(self, items, submit, max_inflight, timeout):
+        """
+        Send submit(item) -> msgid for each item, keeping up to max_inflight
+        operations outstanding on the connection, and yield
+        (item, entries, error) as each one completes: entries holds the
+        search entries received, error is None on success. Operations still
+        pending after timeout seconds (None: no limit) are abandoned.
+        """
+        items = iter(items)
+        # msgid -> [item, deadline, entries]
+        inflight = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(inflight) < max_inflight:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    try:
+                        msgid = submit(item)
+                    except ldap.LDAPError as e:
+                        yield item, None, error_message(e)
+                        continue
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    inflight[msgid] = [item, deadline, []]
+                if not inflight:
+                    return
+
+                wait = -1
+                if timeout is not None:
+                    nearest = min(op[1] for op in inflight.values())
+                    wait = max(0, nearest - time.monotonic())
+                try:
+                    rtype, rdata, msgid, _ = self._conn.result3(ldap.RES_ANY, all=0, timeout=wait)
+                except ldap.TIMEOUT:
+                    rtype = None
+                except ldap.LDAPError as e:
+                    # failed operations come back as exceptions carrying their msgid
+                    info = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+                    if info.get("msgid") not in inflight:
+                        raise
+                    yield inflight.pop(info["msgid"])[0], None, error_message(e)
+                    continue
+
+                if rtype is None:
+                    now = time.monotonic()
+                    for msgid in [m for m, op in inflight.items() if op[1] <= now]:
+                        self._abandon(msgid)
+                        yield inflight.pop(msgid)[0], None, f"Timed out after {timeout}s"
+                    continue
+                op = inflight.get(msgid)
+                if op is None:
+                    # late answer to an abandoned operation
+                    continue
+                if rtype == ldap.RES_SEARCH_ENTRY:
+                    op[2].extend(rdata)
+                elif rtype != ldap.RES_SEARCH_REFERENCE:
+                    del inflight[msgid]
+                    yield op[0], op[2], None
+        finally:
+            for msgid in inflight:
+                self._abandon(msgid)
+
+    def search_many(
+        self,
+        basedn,
+        objects_to_search,
+        attributes_to_search,
+        max_inflight=50,
+        timeout=30,
+        escape_wildchar=True,
+    ):
+        """
+        Run many searches at once on this connection instead of one round
+        trip each: up to max_inflight are outstanding, each abandoned after
+        timeout seconds. Returns {filter: entries} in input order, entries
+        being False for the searches that failed.
+        """
+        objects_to_search = list(dict.fromkeys(objects_to_search))
+        log.info(f"Searching {len(objects_to_search)} filters, {max_inflight} at a time")
+
+        def submit(object_to_search):
+            if escape_wildchar:
+                object_to_search = escape_filter_chars(object_to_search)
+            return self._conn.search_ext(
+                basedn, ldap.SCOPE_SUBTREE, object_to_search, attributes_to_search
+            )
+
+        results = {}
+        started = time.perf_counter()
+        for object_to_search, entries, error in self._pipeline(
+            objects_to_search, submit, max_inflight, timeout
+        ):
+            if error is not None:
+                log.error(f"Problem while searching {object_to_search}: {error}")
+                results[object_to_search] = False
+            else:
+                results[object_to_search] = entries
+        failed = sum(1 for entries in results.values() if entries is False)
+        log.info(
+            f"{len(results)} searches done in {time.perf_counter() - started:.2f}s, {failed} failed"
+        )
+        return {object_to_search: results[object_to_search] for object_to_search in objects_to_search}
+
+    def _abandon(self, msgid):
+        try:
+            self._conn.abandon(msgid)
+        except ldap.LDAPError as e:
+            log.debug(f"Abandon of message {msgid} failed: {error_message(e)}")
+
+    def _release_paged_search(self, basedn, object_to_search, cookie):
+        """A page request of size 0 with the cookie ends the paged search (RFC 2696)"""
+        control = SimplePagedResultsControl(True, size=0, cookie=cookie)
+        try:
+            msgid = self._conn.search_ext(
+                basedn, ldap.SCOPE_SUBTREE, object_to_search, ["1.1"], serverctrls=[control]
+            )
+            self._conn.result3(msgid)
+        except ldap.LDAPError as e:
+            log.debug(f"Release of the paged search failed: {error_message(e)}")
+
     def move_to_newrdn(self, object_to_move, old_branch, new_branch, del_old=False):
         """
         Refer to the docs https://www.python-ldap.org/en/python-ldap-3.3.0/reference/ldap.html?highlight=newrdn#ldap.LDAPObject.rename_s
@@ -8,6 +8,8 @@ __status__ = "Production"
 
 try:
     import pymysql
+    import pymysql.cursors
+    from pymysql.constants import FIELD_TYPE
     from pymysql.err import Error
 except ImportError:
     print("pymysql module is missing! please install it and re-run")
@@ -16,9 +18,18 @@ except ImportError:
 
 
 import os
+import ast
+import time
+import tempfile
+import threading
+import itertools
+from collections.abc import Mapping
+from collections import deque
+from contextlib import contextmanager
+
 ###################### LOGGING PART #####################
 import logging
-from utils import log_abu_settings, cleanup
+from utils import log_abu_settings, cleanup, columns_from_cursor, QUERY_STATS
 
 LOGS_DIR = "logs"
 # get the path of the module
@@ -31,20 +42,68 @@ log = logging.getLogger()
 #########################################################
 
 ERR_TEMPLATE = "An exception of type {0} occurred. Arguments:\n{1!r}"
+# array.array typecodes for the numeric columns of fetch_columnar
+COLUMNAR_TYPECODES = {
+    FIELD_TYPE.TINY: "q",
+    FIELD_TYPE.SHORT: "q",
+    FIELD_TYPE.INT24: "q",
+    FIELD_TYPE.LONG: "q",
+    FIELD_TYPE.LONGLONG: "q",
+    FIELD_TYPE.YEAR: "q",
+    FIELD_TYPE.FLOAT: "d",
+    FIELD_TYPE.DOUBLE: "d",
+}
+# room left in max_allowed_packet for the packet header
+PACKET_HEADROOM = 1024
+# default LOAD DATA escaping: backslash, tab, newline, carriage return, NUL
+LOAD_DATA_ESCAPES = [
+    (b"\\", b"\\\\"),
+    (b"\t", b"\\t"),
+    (b"\n", b"\\n"),
+    (b"\r", b"\\r"),
+    (b"\0", b"\\0"),
+]
+
+
+def quote_identifier(name):
+    """Backtick-quote a (possibly db-qualified) table or column name"""
+    return ".".join("`" + part.replace("`", "``") + "`" for part in name.split("."))
+
+
+def load_data_field(value):
+    """Encode a value as a field of a default-format LOAD DATA file"""
+    if value is None:
+        return b"\\N"
+    if isinstance(value, bool):
+        return b"1" if value else b"0"
+    if isinstance(value, (bytes, bytearray)):
+        data = bytes(value)
+    else:
+        data = str(value).encode("utf-8")
+    for char, escaped in LOAD_DATA_ESCAPES:
+        data = data.replace(char, escaped)
+    return data
 
 
 class MySQL_client:
     """MySQL Database Client"""
 
-    def __init__(self, host, port, user, passwd, db, ssl):
+    def __init__(self, host, port, user, passwd, db, ssl, pool=None, local_infile=False):
         self._host = host
         self._port = port
         self._user = user
         self._passwd = passwd
         self._db = db
         self._ssl = ssl
-        self._conn = self.connection
+        # needed by bulk_insert(load_data=True)
+        self._local_infile = local_infile
+        # when a pool is given the connection is borrowed from it
+        # and handed back on close() instead of being closed
+        self._pool = pool
+        self._conn = pool.acquire() if pool is not None else self.connection
         self._cursor = self._conn.cursor()
+        # statement the fetched bytes are accounted to in QUERY_STATS
+        self._last_sql = None
 
     @property
     def connection(self):
@@ -52,6 +111,7 @@ class MySQL_client:
             log.info("Connecting to the Database...")
             # REMOVE THIS LINE IN PRODUCTION
             log.debug(f"Connecting to the DB with {self.__dict__}")
+            started = time.perf_counter()
             conn = pymysql.connect(
                 host=self._host,
                 port=self._port,
@@ -59,7 +119,9 @@ class MySQL_client:
                 password=self._passwd,
                 db=self._db,
                 ssl=self._ssl,
+                local_infile=self._local_infile,
             )
+            QUERY_STATS.record_wait(time.perf_counter() - started)
             log.info("Connected to the Database Successfully!")
             return conn
         except Error as db_err:
@@ -78,30 +140,238 @@ class MySQL_client:
         if commit:
             self.commit()
         self.cursor.close()
-        self._conn.close()
+        if self._pool is not None:
+            self._pool.release(self._conn)
+        else:
+            self._conn.close()
 
     def execute(self, sql, params=None):
         log.info("Executing the Query...")
         log.debug(f"Query Statement: {sql}, params: {params}")
+        self._last_sql = sql
+        started = time.perf_counter()
         try:
             self.cursor.execute(sql, params or ())
             log.info(f"Query Executed Successfully!")
         except Error as exec_err:
             log.error(f"Query Execution Failed: {exec_err}")
             raise exec_err
+        QUERY_STATS.record(sql, time.perf_counter() - started, self.cursor.rowcount, params)
 
     def fetchall(self):
         log.debug("Fetching all rows...")
-        return self.cursor.fetchall()
+        rows = self.cursor.fetchall()
+        QUERY_STATS.record_fetch(self._last_sql, rows)
+        return rows
 
     def fetchone(self):
         log.debug("Fetching only one row...")
-        return self.cursor.fetchone()
+        row = self.cursor.fetchone()
+        if row is not None:
+            QUERY_STATS.record_fetch(self._last_sql, (row,))
+        return row
 
     def query(self, sql, params=None):
         self.execute(sql, params or ())
         return self.fetchall()
 
+    def fetch_columnar(self, batch_size=10000, as_numpy=True):
+        """Fetch the remaining rows as a dict of column name -> array"""
+        log.debug("Fetching all rows as columns...")
+        return columns_from_cursor(self.cursor, COLUMNAR_TYPECODES, batch_size, as_numpy)
+
+    def query_columnar(self, sql, params=None, batch_size=10000, as_numpy=True):
+        """Run the query on an unbuffered cursor and build the columns batch by batch"""
+        log.info("Executing the Query (columnar)...")
+        log.debug(f"Query Statement: {sql}, params: {params}")
+        cursor = self._conn.cursor(pymysql.cursors.SSCursor)
+        started = time.perf_counter()
+        try:
+            try:
+                cursor.execute(sql, params or ())
+            except Error as exec_err:
+                log.error(f"Query Execution Failed: {exec_err}")
+                raise exec_err
+            columns = columns_from_cursor(cursor, COLUMNAR_TYPECODES, batch_size, as_numpy)
+        finally:
+            cursor.close()
+        rows = len(next(iter(columns.values()))) if columns else 0
+        QUERY_STATS.record(sql, time.perf_counter() - started, rows, params)
+        return columns
+
+    def iter_query(self, sql, params=None, batch_size=None, fetch_size=1000):
+        """Stream rows of the query through an unbuffered server-side cursor
+
+        Yields one row at a time, or lists of up to batch_size rows when
+        batch_size is given. Only fetch_size rows are held in memory at once.
+        The connection can't run other statements until the generator is
+        exhausted or closed; the cursor is closed either way.
+        """
+        log.info("Executing the Query (streaming)...")
+        log.debug(f"Query Statement: {sql}, params: {params}")
+        cursor = self._conn.cursor(pymysql.cursors.SSCursor)
+        started = time.perf_counter()
+        streamed = 0
+        try:
+            try:
+                cursor.execute(sql, params or ())
+            except Error as exec_err:
+                log.error(f"Query Execution Failed: {exec_err}")
+                raise exec_err
+
+            size = batch_size or fetch_size
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                streamed += len(rows)
+                QUERY_STATS.record_fetch(sql, rows)
+                if batch_size:
+                    yield list(rows)
+                else:
+                    yield from rows
+        finally:
+            log.debug("Closing the streaming cursor")
+            cursor.close()
+            # wall time includes the time spent by the consumer between batches
+            QUERY_STATS.record(sql, time.perf_counter() - started, streamed, params)
+
+    def bulk_insert(
+        self,
+        table,
+        rows,
+        columns=None,
+        upsert=False,
+        update_columns=None,
+        batch_size=1000,
+        commit_every=10,
+        load_data=False,
+    ):
+        """Insert many rows with multi-row INSERT statements
+
+        rows is an iterable of tuples (columns is then required) or dicts
+        (columns default to the keys of the first one). Rows are packed
+        into INSERT ... VALUES statements of at most batch_size rows that
+        never exceed the server max_allowed_packet. With upsert the
+        update_columns (all columns by default) are refreshed through
+        ON DUPLICATE KEY UPDATE. A commit is done every commit_every
+        batches and at the end; commit_every=None leaves it to the caller.
+
+        With load_data the rows are spooled to a temporary file and sent
+        with LOAD DATA LOCAL INFILE (upsert becomes REPLACE); the client
+        must be created with local_infile=True.
+
+        Returns a dict with rows, batches, seconds and rows_per_sec.
+        """
+        rows = iter(rows)
+        first = next(rows, None)
+        stats = {"rows": 0, "batches": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+        if first is None:
+            log.info("Bulk insert called without rows, nothing to do")
+            return stats
+
+        if isinstance(first, Mapping):
+            columns = list(columns or first.keys())
+
+            def to_tuple(row):
+                return tuple(row[column] for column in columns)
+
+        else:
+            if not columns:
+                raise ValueError("columns are required when rows are not dicts")
+            to_tuple = tuple
+        rows = (to_tuple(row) for row in itertools.chain([first], rows))
+
+        log.info(f"Bulk inserting into {table}...")
+        started = time.perf_counter()
+        try:
+            if load_data:
+                self._bulk_load_data(table, rows, columns, upsert, stats)
+            else:
+                self._bulk_insert_values(
+                    table, rows, columns, upsert, update_columns, batch_size, commit_every, stats
+                )
+            if commit_every:
+                self.commit()
+        except Error as exec_err:
+            log.error(f"Bulk Insert Failed after {stats['rows']} rows: {exec_err}")
+            raise exec_err
+
+        stats["seconds"] = time.perf_counter() - started
+        if stats["seconds"] > 0:
+            stats["rows_per_sec"] = stats["rows"] / stats["seconds"]
+        log.info(
+            f"Bulk insert done: {stats['rows']} rows in {stats['batches']} batches, "
+            f"{stats['seconds']:.2f}s ({stats['rows_per_sec']:.0f} rows/sec)"
+        )
+        return stats
+
+    def _bulk_insert_values(
+        self, table, rows, columns, upsert, update_columns, batch_size, commit_every, stats
+    ):
+        column_sql = ", ".join(quote_identifier(column) for column in columns)
+        head = f"INSERT INTO {quote_identifier(table)} ({column_sql}) VALUES "
+        tail = ""
+        if upsert:
+            updates = ", ".join(
+                f"{quote_identifier(column)} = VALUES({quote_identifier(column)})"
+                for column in update_columns or columns
+            )
+            tail = f" ON DUPLICATE KEY UPDATE {updates}"
+
+        self.cursor.execute("SELECT @@max_allowed_packet")
+        packet_limit = self.cursor.fetchone()[0] - PACKET_HEADROOM
+        encoding = self._conn.encoding
+        base_size = len(head.encode(encoding)) + len(tail.encode(encoding))
+        log.debug(f"Bulk insert packet limit: {packet_limit} bytes, batch size: {batch_size}")
+
+        values = []
+        size = base_size
+        for row in rows:
+            literal = self._conn.escape(row)
+            literal_size = len(literal.encode(encoding)) + 1
+            if values and (len(values) >= batch_size or size + literal_size > packet_limit):
+                self._flush_values(head, values, tail, commit_every, stats)
+                values = []
+                size = base_size
+            values.append(literal)
+            size += literal_size
+        if values:
+            self._flush_values(head, values, tail, commit_every, stats)
+
+    def _flush_values(self, head, values, tail, commit_every, stats):
+        # no params: the literals are already escaped and must not be %-formatted
+        statement = head + ",".join(values) + tail
+        started = time.perf_counter()
+        self.cursor.execute(statement)
+        # fingerprinting the literals costs ms per batch, the key is what it would give
+        QUERY_STATS.record(head + "(?+)" + tail, time.perf_counter() - started, len(values))
+        stats["rows"] += len(values)
+        stats["batches"] += 1
+        log.debug(f"Batch {stats['batches']} sent, {stats['rows']} rows so far")
+        if commit_every and stats["batches"] % commit_every == 0:
+            self.commit()
+
+    def _bulk_load_data(self, table, rows, columns, upsert, stats):
+        column_sql = ", ".join(quote_identifier(column) for column in columns)
+        duplicate = "REPLACE" if upsert else ""
+        # default FIELDS/LINES options: tab separated, backslash escaped, \N is NULL
+        sql = (
+            f"LOAD DATA LOCAL INFILE %s {duplicate} INTO TABLE {quote_identifier(table)} "
+            f"CHARACTER SET utf8mb4 ({column_sql})"
+        )
+        with tempfile.NamedTemporaryFile("wb", suffix=".tsv") as spool:
+            for row in rows:
+                spool.write(b"\t".join(load_data_field(value) for value in row) + b"\n")
+                stats["rows"] += 1
+            spool.flush()
+            log.debug(f"Spooled {stats['rows']} rows to {spool.name}, loading...")
+            started = time.perf_counter()
+            self.cursor.execute(sql, (spool.name,))
+            # keyed by the statement, the rows stay in the spool file
+            QUERY_STATS.record(sql, time.perf_counter() - started, stats["rows"])
+        stats["batches"] += 1
+
     def pass_params_example(self, country_param):
 
         params = (country_param,)
@@ -114,6 +384,49 @@ class MySQL_client:
 
         return results
 
+    def search_in(
+        self, table, column, values, chunk_size=1000, temp_table_threshold=20000
+    ):
+        """Fetch the rows of table whose column is one of values
+
+        Values are de-duplicated, then searched with IN (...) queries of at
+        most chunk_size placeholders on the same connection. Above
+        temp_table_threshold distinct values they are loaded into a
+        temporary table and joined instead. Results are merged in one tuple.
+        """
+        keys = list(dict.fromkeys(values))
+        log.info(f"Searching {len(keys)} distinct values of {column} in {table}")
+        if not keys:
+            return ()
+        if len(keys) > temp_table_threshold:
+            return self._search_in_temp_table(table, column, keys)
+
+        sql = f"select * from {quote_identifier(table)} where {quote_identifier(column)} in"
+        results = []
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start : start + chunk_size]
+            where_in = ",".join(["%s"] * len(chunk))
+            results.extend(self.query(f"{sql} ({where_in})", chunk))
+        return tuple(results)
+
+    def _search_in_temp_table(self, table, column, keys):
+        tmp_table = "search_in_keys"
+        quoted_tmp = quote_identifier(tmp_table)
+        log.debug(f"Loading {len(keys)} keys in temporary table {tmp_table}")
+        # copy the column definition so the join compares same type and collation
+        self.execute(
+            f"CREATE TEMPORARY TABLE {quoted_tmp} AS SELECT {quote_identifier(column)} AS k "
+            f"FROM {quote_identifier(table)} WHERE 1 = 0"
+        )
+        try:
+            self.bulk_insert(tmp_table, ((key,) for key in keys), columns=["k"], commit_every=None)
+            return self.query(
+                f"select t.* from {quote_identifier(table)} t "
+                f"join {quoted_tmp} s on t.{quote_identifier(column)} = s.k"
+            )
+        finally:
+            self.execute(f"DROP TEMPORARY TABLE IF EXISTS {quoted_tmp}")
+
     def search_data_by_pattern(self, pattern, search_type, auto_close=True):
         """Fetch data by given sql, pattern and type of search"""
 
@@ -123,14 +436,17 @@ class MySQL_client:
             sql_query = f"{sql} lower(country) like lower(%s)"
 
         elif search_type == "in":
-            # String To Tuple
-            params = eval(pattern)
-            # Count how many items inside to pattern,
-            # in order to add placeholder '%s' to the query
-            how_many_items = pattern.split(",")
-            # for example, two items will be 'in (%s, %s)'
-            where_in = ",".join(["%s"] * len(how_many_items))
-            sql_query = f"{sql} country in ({where_in})"
+            values = pattern
+            if isinstance(pattern, str):
+                # old callers pass the list as a string, e.g. "'Italy', 'Spain'"
+                values = ast.literal_eval(pattern)
+                if not isinstance(values, (tuple, list, set, frozenset)):
+                    values = (values,)
+            results = self.search_in("db.users", "country", values)
+            if auto_close:
+                self.close()
+
+            return results
 
         else:
             sql_query = f"{sql} lower(country) = lower(%s)"
@@ -142,6 +458,218 @@ class MySQL_client:
         return results
 
 
+class MySQL_pool:
+    """Bounded, thread-safe pool of pymysql connections
+
+    Connections are checked out with acquire() (or the client() context
+    manager) and handed back with release(). Idle connections older than
+    idle_timeout are dropped down to min_size, every connection is
+    recycled after max_lifetime seconds and a ping is done on checkout.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        user,
+        passwd,
+        db,
+        ssl,
+        min_size=1,
+        max_size=10,
+        idle_timeout=300,
+        max_lifetime=3600,
+        checkout_timeout=30,
+        local_infile=False,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool size must satisfy 0 <= min_size <= max_size, max_size >= 1")
+
+        self._config = {
+            "host": host,
+            "port": port,
+            "user": user,
+            "passwd": passwd,
+            "db": db,
+            "ssl": ssl,
+            "local_infile": local_infile,
+        }
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+
+        self._lock = threading.Condition()
+        # idle connections as [conn, created_at, last_used], most recent on the right
+        self._idle = deque()
+        # id(conn) -> created_at for every connection currently checked out
+        self._in_use = {}
+        self._size = 0
+        self._closed = False
+
+        for _ in range(min_size):
+            conn = self._connect()
+            now = time.monotonic()
+            self._idle.append([conn, now, now])
+            self._size += 1
+        log.info(f"Connection pool ready with {self._size} connection(s), max {max_size}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self):
+        log.debug("Opening a new pooled connection...")
+        conn = pymysql.connect(
+            host=self._config["host"],
+            port=self._config["port"],
+            user=self._config["user"],
+            password=self._config["passwd"],
+            db=self._config["db"],
+            ssl=self._config["ssl"],
+            local_infile=self._config["local_infile"],
+        )
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
+
+    def _expired(self, created_at, last_used, now):
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return True
+        if (
+            self.idle_timeout
+            and now - last_used > self.idle_timeout
+            and self._size > self.min_size
+        ):
+            return True
+        return False
+
+    def _is_alive(self, conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Error as e:
+            log.debug(f"Pooled connection failed liveness check: {e}")
+            return False
+
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to timeout seconds for a free slot"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            to_discard = []
+            conn = created_at = None
+            with self._lock:
+                while conn is None:
+                    if self._closed:
+                        raise RuntimeError("Connection pool is closed")
+                    now = time.monotonic()
+                    while self._idle:
+                        candidate, c_created, c_used = self._idle.pop()
+                        if self._expired(c_created, c_used, now):
+                            self._size -= 1
+                            to_discard.append(candidate)
+                            continue
+                        conn, created_at = candidate, c_created
+                        break
+                    if conn is not None:
+                        break
+                    if self._size < self.max_size:
+                        # reserve the slot, the handshake is done outside the lock
+                        self._size += 1
+                        created_at = None
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            f"No connection available in the pool after {timeout}s"
+                        )
+                    self._lock.wait(remaining)
+
+            for stale in to_discard:
+                log.debug("Dropping expired pooled connection")
+                self._discard(stale)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._lock.notify()
+                    raise
+                created_at = time.monotonic()
+            elif not self._is_alive(conn):
+                self._discard(conn)
+                with self._lock:
+                    self._size -= 1
+                    self._lock.notify()
+                continue
+
+            with self._lock:
+                self._in_use[id(conn)] = created_at
+            QUERY_STATS.record_wait(time.monotonic() - started)
+            return conn
+
+    def release(self, conn):
+        """Hand a connection back, rolling back any open transaction"""
+        with self._lock:
+            created_at = self._in_use.pop(id(conn), None)
+        if created_at is None:
+            log.debug("Connection is not checked out from this pool, ignoring")
+            return
+
+        healthy = conn.open
+        if healthy:
+            try:
+                conn.rollback()
+            except Error as e:
+                log.debug(f"Rollback failed, dropping pooled connection: {e}")
+                healthy = False
+
+        with self._lock:
+            if healthy and not self._closed:
+                self._idle.append([conn, created_at, time.monotonic()])
+                conn = None
+            else:
+                self._size -= 1
+            self._lock.notify()
+
+        if conn is not None:
+            self._discard(conn)
+
+    @contextmanager
+    def client(self):
+        """Yield a MySQL_client bound to a pooled connection"""
+        db_client = MySQL_client(**self._config, pool=self)
+        try:
+            yield db_client
+        finally:
+            db_client.close()
+
+    def close(self):
+        """Close idle connections, checked out ones are closed on release"""
+        with self._lock:
+            self._closed = True
+            idle = [item[0] for item in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._lock.notify_all()
+        log.debug(f"Closing {len(idle)} idle pooled connection(s)")
+        for conn in idle:
+            self._discard(conn)
+
+
 if __name__ == "__main__":
     # custom logging options
     log_abu_settings(
@@ -1,9 +1,123 @@
+import time
+import uuid
+import queue
+import struct
+import itertools
 import logging
+import datetime
+import threading
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+from collections import deque
+from contextlib import contextmanager
+from psycopg2 import sql as pgsql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from utils import columns_from_cursor, QUERY_STATS
 
 
 log = logging.getLogger(__name__)
 ERR_TEMPLATE = "An exception of type {0} occurred. Arguments: {1!r}"
+# array.array typecodes by type OID (int2, int4, int8, oid, float4, float8)
+COLUMNAR_TYPECODES = {21: "q", 23: "q", 20: "q", 26: "q", 700: "d", 701: "d"}
+
+COPY_FORMATS = ("csv", "binary")
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = struct.pack("!h", -1)
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+# struct formats of the fixed size types by OID: bool, int2, int4, int8, float4, float8
+BINARY_STRUCTS = {16: "!?", 21: "!h", 23: "!i", 20: "!q", 700: "!f", 701: "!d"}
+# text like types by OID: text, varchar, bpchar, name, json, xml
+BINARY_TEXT_TYPES = (25, 1043, 1042, 19, 114, 142)
+
+
+def csv_row(row):
+    """Encode a row for COPY ... (FORMAT csv), None is NULL and everything else is quoted"""
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append("")
+            continue
+        if isinstance(value, bool):
+            text = "true" if value else "false"
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            text = "\\x" + bytes(value).hex()
+        else:
+            text = str(value)
+        fields.append('"' + text.replace('"', '""') + '"')
+    return (",".join(fields) + "\n").encode("utf-8")
+
+
+def binary_value(oid, value):
+    """Encode a value in the binary COPY representation of type oid"""
+    if oid in BINARY_STRUCTS:
+        return struct.pack(BINARY_STRUCTS[oid], value)
+    if oid in BINARY_TEXT_TYPES:
+        return str(value).encode("utf-8")
+    if oid == 3802:  # jsonb, version 1 followed by the text
+        return b"\x01" + str(value).encode("utf-8")
+    if oid == 17:  # bytea
+        return bytes(value)
+    if oid == 1082:  # date, days since 2000-01-01
+        return struct.pack("!i", (value - PG_EPOCH.date()).days)
+    if oid in (1114, 1184):  # timestamp(tz), microseconds since 2000-01-01
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        delta = value - PG_EPOCH
+        return struct.pack("!q", (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+    raise ValueError(f"Type OID {oid} is not supported by binary COPY, use format='csv'")
+
+
+def binary_row(oids, row):
+    """Encode a row as a binary COPY tuple"""
+    parts = [struct.pack("!h", len(oids))]
+    for oid, value in zip(oids, row):
+        if value is None:
+            parts.append(struct.pack("!i", -1))
+        else:
+            data = binary_value(oid, value)
+            parts.append(struct.pack("!i", len(data)))
+            parts.append(data)
+    return b"".join(parts)
+
+
+class IterableReader:
+    """Read-only file-like object over an iterator of bytes chunks, for copy_expert"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class QueueWriter:
+    """Write-only file-like object feeding a bounded queue, for copy_expert"""
+
+    def __init__(self, chunks, stop):
+        self._chunks = chunks
+        self._stop = stop
+
+    def write(self, data):
+        data = bytes(data)
+        while True:
+            if self._stop.is_set():
+                raise IOError("COPY consumer stopped reading")
+            try:
+                self._chunks.put(data, timeout=0.5)
+                return len(data)
+            except queue.Full:
+                continue
 
 
 class PostgresClient:
@@ -14,6 +128,7 @@ class PostgresClient:
         postgres_user,
         postgres_password,
         postgres_db,
+        pool=None,
     ):
         self._host = postgres_host
         self._port = postgres_port
@@ -21,14 +136,19 @@ class PostgresClient:
         self._passwd = postgres_password
         self._db = postgres_db
         # self._ssl = ssl
-        self._conn = self.connection
-        if self._conn:
-            self._cursor = self._conn.cursor()
+        # when a pool is given the connection is borrowed from it
+        # and handed back on close() instead of being closed
+        self._pool = pool
+        self._conn = pool.getconn() if pool is not None else self.connection
+        self._cursor = self._conn.cursor() if self._conn else None
+        # statement the fetched bytes are accounted to in QUERY_STATS
+        self._last_sql = None
 
     @property
     def connection(self):
         try:
             log.info("Trying to connect to Database...")
+            started = time.perf_counter()
             conn = psycopg2.connect(
                 user=self._user,
                 password=self._passwd,
@@ -36,6 +156,7 @@ class PostgresClient:
                 port=self._port,
                 database=self._db,
             )
+            QUERY_STATS.record_wait(time.perf_counter() - started)
             log.info("Connected to the Database successfully!")
             return conn
         except psycopg2.Error as error:
@@ -52,8 +173,15 @@ class PostgresClient:
 
     def close(self):
         log.debug("Closing the cursor and the connection...")
-        self.cursor.close()
-        self._conn.close()
+        if self._cursor is not None:
+            self._cursor.close()
+        if self._pool is not None:
+            self._pool.putconn(self._conn)
+        elif self._conn:
+            self._conn.close()
+
+    def commit(self):
+        self._conn.commit()
 
     def rollback(self):
         # If an exception occurs while executing an SQL statement you need to call the connection's rollback method
@@ -62,12 +190,15 @@ class PostgresClient:
         log.debug("Resetting the connection cursor")
         self._conn.rollback()
 
-    def execute(self, sql):
+    def execute(self, sql, params=None):
         log.info(f"Executing the Query: '{sql}'")
-        log.debug(f"Query Statement: {sql}")
+        log.debug(f"Query Statement: {sql}, params: {params}")
+        self._last_sql = sql
 
         try:
-            self.cursor.execute(sql)
+            started = time.perf_counter()
+            self.cursor.execute(sql, params)
+            QUERY_STATS.record(sql, time.perf_counter() - started, self.cursor.rowcount, params)
             log.info(f"Query Executed Successfully!")
             return True
         except psycopg2.Error as exec_err:
@@ -78,13 +209,472 @@ class PostgresClient:
 
         return False
 
+    def execute_values(self, sql, rows, template=None, page_size=1000, commit=True):
+        """
+        Run sql once per page of page_size rows, with the single %s
+        placeholder expanded to a VALUES list, e.g.
+        INSERT INTO t (a, b) VALUES %s or
+        UPDATE t SET b = v.b FROM (VALUES %s) AS v (a, b) WHERE t.a = v.a.
+        rows can be any iterable. Returns the number of rows sent, False on failure.
+        """
+        log.info(f"Executing the Query in pages of {page_size} rows: '{sql}'")
+        sent = [0]
+
+        def count(iterable):
+            for row in iterable:
+                sent[0] += 1
+                yield row
+
+        try:
+            started = time.perf_counter()
+            psycopg2.extras.execute_values(
+                self.cursor, sql, count(rows), template=template, page_size=page_size
+            )
+            QUERY_STATS.record(sql, time.perf_counter() - started, sent[0])
+            if commit:
+                self.commit()
+            log.info(f"Query Executed Successfully for {sent[0]} rows!")
+            return sent[0]
+        except psycopg2.Error as exec_err:
+            log.error(f"Query Execution Failed after {sent[0]} rows: {exec_err}")
+            self.rollback()
+        except Exception as e:
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            self.rollback()
+
+        return False
+
+    def execute_batch_statements(self, statements, commit=True):
+        """
+        Send a list of statements (sql strings or (sql, params) pairs) to the
+        server in a single round trip and a single transaction.
+        On failure nothing is applied and False is returned.
+        """
+        log.info(f"Executing a batch of {len(statements)} statements...")
+        try:
+            parts = []
+            for statement in statements:
+                if isinstance(statement, (tuple, list)):
+                    sql, params = statement
+                    encoding = psycopg2.extensions.encodings[self._conn.encoding]
+                    parts.append(self.cursor.mogrify(sql, params).decode(encoding))
+                else:
+                    parts.append(statement)
+            batch = ";\n".join(part.rstrip().rstrip(";") for part in parts)
+            log.debug(f"Batch Statement: {batch}")
+            started = time.perf_counter()
+            self.cursor.execute(batch)
+            QUERY_STATS.record(batch, time.perf_counter() - started, self.cursor.rowcount)
+            if commit:
+                self.commit()
+            log.info("Batch Executed Successfully!")
+            return True
+        except psycopg2.Error as exec_err:
+            log.error(f"Batch Execution Failed: {exec_err}")
+            self.rollback()
+        except Exception as e:
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            self.rollback()
+
+        return False
+
     def fetchall(self):
         log.debug("Fetching all rows...")
         try:
-            return self.cursor.fetchall()
+            rows = self.cursor.fetchall()
+            QUERY_STATS.record_fetch(self._last_sql, rows)
+            return rows
         except psycopg2.Error as error:
             log.error(f"Problem while operating with DB: {error}")
         except Exception as e:
             log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
 
         return False
+
+    def iter_query(self, sql, params=None, itersize=2000, batch_size=None, cursor_name=None):
+        """
+        Stream the query through a named (server-side) cursor.
+        Rows are pulled itersize at a time and yielded one by one, or as
+        lists of batch_size rows. The cursor is closed when the generator
+        is exhausted or abandoned; a transaction opened just for the
+        stream is then committed, or rolled back on errors.
+        """
+        name = cursor_name or f"stream_{uuid.uuid4().hex}"
+        own_transaction = self._conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        log.info(f"Executing the Query on server-side cursor {name}: '{sql}'")
+        log.debug(f"Query Statement: {sql}, params: {params}, itersize: {itersize}")
+
+        cursor = self._conn.cursor(name=name)
+        cursor.itersize = itersize
+        failed = False
+        started = time.perf_counter()
+        streamed = 0
+        try:
+            cursor.execute(sql, params)
+            size = batch_size or itersize
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                streamed += len(rows)
+                QUERY_STATS.record_fetch(sql, rows)
+                if batch_size:
+                    yield rows
+                else:
+                    yield from rows
+        except psycopg2.Error as exec_err:
+            failed = True
+            log.error(f"Query Execution Failed: {exec_err}")
+            raise
+        finally:
+            log.debug(f"Closing server-side cursor {name}")
+            try:
+                cursor.close()
+            except psycopg2.Error as error:
+                log.debug(f"Server-side cursor close failed: {error}")
+                failed = True
+            if failed:
+                self.rollback()
+            elif own_transaction:
+                self.commit()
+            # wall time includes the time spent by the consumer between batches
+            QUERY_STATS.record(sql, time.perf_counter() - started, streamed, params)
+
+    def fetch_columnar(self, batch_size=10000, as_numpy=True):
+        """Fetch the remaining rows as a dict of column name -> array"""
+        log.debug("Fetching all rows as columns...")
+        try:
+            return columns_from_cursor(self.cursor, COLUMNAR_TYPECODES, batch_size, as_numpy)
+        except psycopg2.Error as error:
+            log.error(f"Problem while operating with DB: {error}")
+        except Exception as e:
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+
+        return False
+
+    def _copy_target(self, table, query, columns):
+        if query is not None:
+            return pgsql.SQL("({})").format(pgsql.SQL(query))
+        target = pgsql.Identifier(*table.split("."))
+        if columns:
+            target = pgsql.SQL("{} ({})").format(
+                target, pgsql.SQL(", ").join(pgsql.Identifier(column) for column in columns)
+            )
+        return target
+
+    def _copy_options(self, copy_format, header=False):
+        if copy_format not in COPY_FORMATS:
+            raise ValueError(f"COPY format can be only {COPY_FORMATS}")
+        options = f"FORMAT {copy_format}"
+        if header and copy_format == "csv":
+            options += ", HEADER"
+        return pgsql.SQL(options)
+
+    def _column_oids(self, table, columns):
+        select = pgsql.SQL("SELECT {} FROM {} LIMIT 0").format(
+            pgsql.SQL(", ").join(pgsql.Identifier(column) for column in columns)
+            if columns
+            else pgsql.SQL("*"),
+            pgsql.Identifier(*table.split(".")),
+        )
+        self.cursor.execute(select)
+        return [column.type_code for column in self.cursor.description]
+
+    def copy_from_rows(self, table, rows, columns=None, copy_format="csv", commit=True):
+        """
+        Load rows (an iterable of sequences) into table with COPY FROM STDIN.
+        Rows are encoded lazily while the server reads them, in csv or binary
+        format. Binary needs the column types, which are read from the table.
+        Returns the number of rows copied, False on failure.
+        """
+        log.info(f"Copying rows into {table} ({copy_format})...")
+        statement = pgsql.SQL("COPY {} FROM STDIN WITH ({})").format(
+            self._copy_target(table, None, columns), self._copy_options(copy_format)
+        )
+        copied = [0]
+
+        def count(iterable):
+            for row in iterable:
+                copied[0] += 1
+                yield row
+
+        try:
+            if copy_format == "binary":
+                oids = self._column_oids(table, columns)
+                chunks = itertools.chain(
+                    [BINARY_HEADER],
+                    (binary_row(oids, row) for row in count(rows)),
+                    [BINARY_TRAILER],
+                )
+            else:
+                chunks = (csv_row(row) for row in count(rows))
+            self.cursor.copy_expert(statement, IterableReader(chunks))
+            if commit:
+                self.commit()
+            log.info(f"Copied {copied[0]} rows into {table}")
+            return copied[0]
+        except psycopg2.Error as exec_err:
+            log.error(f"COPY Failed after {copied[0]} rows: {exec_err}")
+            self.rollback()
+        except Exception as e:
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            self.rollback()
+
+        return False
+
+    def copy_to(self, fileobj, table=None, query=None, columns=None, copy_format="csv", header=False):
+        """Export a table or query result with COPY TO STDOUT into a writable file object"""
+        statement = pgsql.SQL("COPY {} TO STDOUT WITH ({})").format(
+            self._copy_target(table, query, columns), self._copy_options(copy_format, header)
+        )
+        log.info(f"Exporting {table or 'query'} with COPY ({copy_format})...")
+        try:
+            self.cursor.copy_expert(statement, fileobj)
+            log.info("Export completed successfully!")
+            return True
+        except psycopg2.Error as exec_err:
+            log.error(f"COPY Failed: {exec_err}")
+            self.rollback()
+        except Exception as e:
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            self.rollback()
+
+        return False
+
+    def iter_copy_to(
+        self, table=None, query=None, columns=None, copy_format="csv", header=False, queue_size=16
+    ):
+        """
+        Export with COPY TO STDOUT as a generator of bytes chunks.
+        The COPY runs in a helper thread and at most queue_size chunks are
+        buffered. If the consumer stops early the COPY is cancelled on the
+        server, so the rest of the export is not transferred, and the
+        transaction is rolled back. Errors are logged and raised.
+        """
+        statement = pgsql.SQL("COPY {} TO STDOUT WITH ({})").format(
+            self._copy_target(table, query, columns), self._copy_options(copy_format, header)
+        )
+        log.info(f"Streaming {table or 'query'} with COPY ({copy_format})...")
+        chunks = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        done = object()
+        errors = []
+
+        def export():
+            try:
+                self.cursor.copy_expert(statement, QueueWriter(chunks, stop))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                while not stop.is_set():
+                    try:
+                        chunks.put(done, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+
+        worker = threading.Thread(target=export, name="pg-copy-to", daemon=True)
+        worker.start()
+        finished = False
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    finished = True
+                    break
+                yield chunk
+        finally:
+            stop.set()
+            if not finished:
+                # otherwise the rollback reads and discards the rest of the COPY
+                try:
+                    self._conn.cancel()
+                except Exception as e:
+                    log.warning(f"Unable to cancel the COPY: {e}")
+            worker.join()
+            if errors or not finished:
+                self.rollback()
+
+        if errors:
+            log.error(f"COPY Failed: {errors[0]}")
+            raise errors[0]
+        log.info("Export completed successfully!")
+
+
+class PostgresPool:
+    """
+    Pool of psycopg2 connections shared by worker threads.
+    Checkout blocks up to checkout_timeout when all max_connections are
+    in use, connections idle for more than health_check_interval seconds
+    are tested with SELECT 1, and any open or failed transaction is rolled
+    back when a connection comes back. Returned connections stay open in
+    the idle list for the next checkout. Nested checkouts from the same
+    thread get the same connection.
+    """
+
+    def __init__(
+        self,
+        postgres_host,
+        postgres_port,
+        postgres_user,
+        postgres_password,
+        postgres_db,
+        min_connections=1,
+        max_connections=10,
+        checkout_timeout=30,
+        health_check_interval=30,
+    ):
+        self._config = {
+            "postgres_host": postgres_host,
+            "postgres_port": postgres_port,
+            "postgres_user": postgres_user,
+            "postgres_password": postgres_password,
+            "postgres_db": postgres_db,
+        }
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        if min_connections < 0 or max_connections < 1 or min_connections > max_connections:
+            raise ValueError(
+                "Pool size must satisfy 0 <= min_connections <= max_connections, max_connections >= 1"
+            )
+        log.info(f"Creating connection pool ({min_connections}-{max_connections} connections)...")
+        # one slot per connection, checked out or idle: callers wait on it when all are in use
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        # idle connections as [conn, last_used], most recent on the right
+        self._idle = deque()
+        # id(conn) -> [conn, depth, thread ident] of checked out connections
+        self._checked_out = {}
+        # thread ident -> id(conn) held by that thread
+        self._by_thread = {}
+        self._closed = False
+        for _ in range(min_connections):
+            self._idle.append([self._connect(), time.monotonic()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closeall()
+
+    def _connect(self):
+        log.debug("Opening a new pooled connection...")
+        return psycopg2.connect(
+            user=self._config["postgres_user"],
+            password=self._config["postgres_password"],
+            host=self._config["postgres_host"],
+            port=self._config["postgres_port"],
+            database=self._config["postgres_db"],
+        )
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error as error:
+            log.debug(f"Closing pooled connection failed: {error}")
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as error:
+            log.debug(f"Pooled connection failed health check: {error}")
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                return self._connect()
+            if self._healthy(*idle):
+                return idle[0]
+            self._discard(idle[0])
+
+    def getconn(self, timeout=None):
+        """Check out a connection, reusing the one already held by this thread"""
+        ident = threading.get_ident()
+        with self._lock:
+            held = self._checked_out.get(self._by_thread.get(ident))
+            if held is not None:
+                held[1] += 1
+                return held[0]
+
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"No connection available in the pool after {timeout}s")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._checked_out[id(conn)] = [conn, 1, ident]
+            self._by_thread[ident] = id(conn)
+        QUERY_STATS.record_wait(time.monotonic() - started)
+        return conn
+
+    def putconn(self, conn):
+        """Hand a connection back, rolling back any transaction left open"""
+        with self._lock:
+            held = self._checked_out.get(id(conn))
+            if held is None:
+                log.debug("Connection is not checked out from this pool, ignoring")
+                return
+            held[1] -= 1
+            if held[1] > 0:
+                return
+            del self._checked_out[id(conn)]
+            if self._by_thread.get(held[2]) == id(conn):
+                del self._by_thread[held[2]]
+
+        discard = conn.closed != 0
+        if not discard:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                log.debug("Rolling back transaction left open on pooled connection")
+                try:
+                    conn.rollback()
+                except psycopg2.Error as error:
+                    log.debug(f"Rollback failed, dropping pooled connection: {error}")
+                    discard = True
+
+        try:
+            with self._lock:
+                if not discard and not self._closed:
+                    self._idle.append([conn, time.monotonic()])
+                    return
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def client(self):
+        """Yield a PostgresClient bound to a pooled connection"""
+        db_client = PostgresClient(**self._config, pool=self)
+        try:
+            yield db_client
+        finally:
+            db_client.close()
+
+    def closeall(self):
+        """Close the idle connections, checked out ones are closed when handed back"""
+        log.debug("Closing all pooled connections...")
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._discard(conn)
@@ -5,23 +5,195 @@ __version__ = 1.0
 __progname__ = "sftp_conn"
 __status__ = "Production"
 
+import os
+import json
+import stat
+import time
+import zlib
+import hashlib
 import socket
+import posixpath
+import itertools
+import threading
 import paramiko
 import logging
 import utils as ut
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for compress/decompress="zstd"
+    zstandard = None
 
 log = logging.getLogger(__name__)
 ERR_TEMPLATE = "An exception of type {0} occurred. Arguments: {1!r}"
+STATE_SUFFIX = ".sftp-state"
+
+
+def split_ranges(size, parts, min_part_size):
+    """[start, end, done] byte ranges covering size, at least min_part_size long"""
+    if size == 0:
+        return [[0, 0, 0]]
+    parts = max(1, min(parts, size // min_part_size))
+    step = -(-size // parts)
+    return [[start, min(start + step, size), 0] for start in range(0, size, step)]
+
+
+def write_confirmed(f, data):
+    """
+    Write data to a pipelined SFTPFile and wait until the server took it:
+    only the last request is sent synchronously, which makes paramiko
+    read the answers to every write sent before it (and raise their errors).
+    """
+    split = max(0, len(data) - f.MAX_REQUEST_SIZE)
+    if split:
+        f.write(data[:split])
+    f.set_pipelined(False)
+    try:
+        f.write(data[split:])
+    finally:
+        f.set_pipelined(True)
+
+
+def iter_source(source, chunk_size):
+    """Byte chunks from a file-like object or an iterable of bytes/str chunks"""
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), None)
+    else:
+        chunks = iter(source)
+    for data in chunks:
+        if isinstance(data, str):
+            data = data.encode()
+        if not data:
+            if hasattr(source, "read"):
+                return
+            continue
+        yield data
+
+
+def _codec(name, compress):
+    if name == "gzip":
+        return zlib.compressobj(wbits=31) if compress else zlib.decompressobj(wbits=31)
+    if name == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd needs the zstandard module: pip install zstandard")
+        if compress:
+            return zstandard.ZstdCompressor().compressobj()
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("compression can be only None, 'gzip' or 'zstd'")
+
+
+def compress_chunks(chunks, compression):
+    if compression is None:
+        return chunks
+    # codec built here, not in the generator, so a bad name fails right away
+    codec = _codec(compression, compress=True)
+
+    def compressed():
+        for data in chunks:
+            yield codec.compress(data)
+        yield codec.flush()
+
+    return compressed()
+
+
+def decompress_chunks(chunks, compression):
+    if compression is None:
+        return chunks
+    codec = _codec(compression, compress=False)
+
+    def decompressed():
+        for data in chunks:
+            yield codec.decompress(data)
+        if compression == "gzip":
+            yield codec.flush()
+
+    return decompressed()
+
+
+class ByteBudget:
+    """Make callers wait while more than limit bytes are in flight"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        # a file bigger than the whole budget runs alone instead of waiting forever
+        size = min(size, self.limit)
+        with self._cond:
+            while self._used and self._used + size > self.limit:
+                self._cond.wait()
+            self._used += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._used -= size
+                self._cond.notify_all()
+
+
+class ListingCache:
+    """Directory listings ({name: attributes}) kept for ttl seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        # "/upload", "/upload/" and "/upload/./" are the same listing
+        return posixpath.normpath(path)
+
+    def get(self, path):
+        path = self._key(path)
+        with self._lock:
+            cached = self._listings.get(path)
+            if cached is None:
+                return None
+            if cached[0] < time.monotonic():
+                del self._listings[path]
+                return None
+            return cached[1]
+
+    def put(self, path, entries):
+        listing = {attr.filename: attr for attr in entries}
+        if self.ttl > 0:
+            with self._lock:
+                self._listings[self._key(path)] = (time.monotonic() + self.ttl, listing)
+        return listing
+
+    def invalidate(self, path):
+        """Forget path and its parent, whose listing holds path's attributes"""
+        path = self._key(path)
+        with self._lock:
+            self._listings.pop(path, None)
+            self._listings.pop(posixpath.dirname(path), None)
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
 
 
 class SFTPConnectionManager:
-    def __init__(self, sftp_host, sftp_port, username, private_key_path, password=None):
+    def __init__(
+        self, sftp_host, sftp_port, username, private_key_path, password=None, listing_ttl=60
+    ):
         self.sftp_host = sftp_host
         self.port = sftp_port
         self.username = username
         self.password = password
         self.private_key_path = private_key_path
         self.client = None
+        # long-lived SFTP session shared by the file operations
+        self._sftp = None
+        self._login_lock = threading.Lock()
+        self._listings = ListingCache(listing_ttl)
 
     def login(self, timeout=30):
         client = paramiko.SSHClient()
@@ -32,7 +204,7 @@ class SFTPConnectionManager:
             return False
         try:
             if self.private_key_path:
-                if not ut.check_rsa_key_path(config.SFTP_PRIVATE_KEY_PATH):
+                if not ut.check_rsa_key_path(self.private_key_path):
                     return False
                 private_key = paramiko.RSAKey.from_private_key_file(
                     self.private_key_path
@@ -73,7 +245,66 @@ class SFTPConnectionManager:
 
         return False
 
+    def _session_alive(self):
+        if self._sftp is None:
+            return False
+        channel = self._sftp.get_channel()
+        transport = self.client.get_transport() if self.client else None
+        return (
+            channel is not None
+            and not channel.closed
+            and transport is not None
+            and transport.is_active()
+        )
+
+    def _open_session(self):
+        if self._session_alive():
+            return self._sftp
+        self._close_session()
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            log.warning("SSH connection lost, logging in again...")
+            if not self.login():
+                raise ConnectionError(f"Unable to reconnect to the host: {self.sftp_host}")
+        log.debug("Opening SFTP session...")
+        self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def _close_session(self):
+        if self._sftp is None:
+            return
+        try:
+            self._sftp.close()
+        except Exception as e:
+            log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
+        self._sftp = None
+
+    def _run(self, operation):
+        """Run operation(sftp) on the session, retried once on a fresh session if it broke"""
+        try:
+            return operation(self._open_session())
+        except Exception as e:
+            if self._session_alive():
+                raise
+            log.warning(f"SFTP session lost ({type(e).__name__}: {e}), re-opening...")
+            self._close_session()
+        return operation(self._open_session())
+
+    @contextmanager
+    def session(self):
+        """Yield the long-lived SFTP session, opened (again) if needed"""
+        if self.client is None:
+            raise ConnectionError("SFTP Not connected.")
+        sftp = self._open_session()
+        try:
+            yield sftp
+        except Exception:
+            if not self._session_alive():
+                self._close_session()
+            raise
+
     def logout(self):
+        self._close_session()
         if self.client:
             self.client.close()
             log.info("SFTP Connection closed.")
@@ -86,9 +317,9 @@ class SFTPConnectionManager:
             log.info("SFTP Not connected.")
             return False
 
-        sftp = self.client.open_sftp()
         try:
-            sftp.put(source_path, destination_path)
+            self._run(lambda sftp: sftp.put(source_path, destination_path))
+            self._listings.invalidate(destination_path)
             log.info(f"File exported from {source_path} to {destination_path}")
             return True
         except Exception as e:
@@ -96,22 +327,779 @@ class SFTPConnectionManager:
             log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
             return False
 
+    def _clone(self):
+        """New manager logged in with the same credentials, None if login fails"""
+        manager = SFTPConnectionManager(
+            self.sftp_host, self.port, self.username, self.private_key_path, self.password, 0
+        )
+        if not manager.login():
+            return None
+        return manager
+
+    @contextmanager
+    def _channels(self, connections):
+        """
+        Yield a function that gives each calling thread its own SFTP channel,
+        spread over connections SSH connections (this one plus extra logins).
+        """
+        managers = [self]
+        for _ in range(max(connections, 1) - 1):
+            manager = self._clone()
+            if manager is None:
+                log.warning("Extra SSH connection failed, going on with fewer connections")
+                break
+            managers.append(manager)
+        log.debug(f"Opening SFTP channels over {len(managers)} connections")
+
+        local = threading.local()
+        counter = itertools.count()
+        channels = []
+        channels_lock = threading.Lock()
+
+        def channel():
+            sftp = getattr(local, "sftp", None)
+            if sftp is None or sftp.get_channel().closed:
+                manager = managers[next(counter) % len(managers)]
+                sftp = local.sftp = manager.client.open_sftp()
+                with channels_lock:
+                    channels.append(sftp)
+            return sftp
+
+        try:
+            yield channel
+        finally:
+            for sftp in channels:
+                try:
+                    sftp.close()
+                except Exception as e:
+                    log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            for manager in managers[1:]:
+                manager.logout()
+
+    def transfer_many(
+        self,
+        pairs,
+        direction="upload",
+        connections=2,
+        workers=4,
+        max_inflight_bytes=256 * 1024 * 1024,
+        retries=2,
+        retry_delay=1.0,
+        preserve_mtime=False,
+    ):
+        """
+        Upload or download many (source, destination) pairs concurrently.
+        workers threads each get their own SFTP channel, spread over
+        connections SSH connections (this one plus extra logins). Transfers
+        wait while max_inflight_bytes are already being sent, and each file
+        is retried up to retries times with exponential backoff. With
+        preserve_mtime=True the destination gets the source's mtime.
+        Returns a report dict with succeeded, failed, bytes, seconds and
+        files (one dict per pair, in input order).
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+        if direction not in ("upload", "download"):
+            raise ValueError("direction can be only 'upload' or 'download'")
+
+        pairs = list(pairs)
+        log.info(
+            f"Transferring {len(pairs)} files ({direction}) with {workers} workers "
+            f"over {connections} connections"
+        )
+        budget = ByteBudget(max_inflight_bytes)
+
+        def transfer(pair):
+            source, destination = pair
+            result = {"source": source, "destination": destination, "ok": False, "attempts": 0}
+            for attempt in range(retries + 1):
+                result["attempts"] = attempt + 1
+                started = time.perf_counter()
+                try:
+                    sftp = channel()
+                    if direction == "upload":
+                        size = os.path.getsize(source)
+                        with budget.reserve(size):
+                            sftp.put(source, destination)
+                        if preserve_mtime:
+                            source_stat = os.stat(source)
+                            sftp.utime(destination, (source_stat.st_atime, source_stat.st_mtime))
+                    else:
+                        size = sftp.stat(source).st_size
+                        with budget.reserve(size):
+                            sftp.get(source, destination)
+                        if preserve_mtime:
+                            source_stat = sftp.stat(source)
+                            os.utime(destination, (source_stat.st_atime, source_stat.st_mtime))
+                    result.update(ok=True, bytes=size, seconds=time.perf_counter() - started)
+                    result.pop("error", None)
+                    return result
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    log.warning(f"Transfer of {source} failed (attempt {attempt + 1}): {e}")
+                    if isinstance(e, (FileNotFoundError, PermissionError)):
+                        # not going to get better by retrying
+                        break
+                    if attempt < retries:
+                        time.sleep(retry_delay * 2**attempt)
+            log.error(f"Transfer of {source} failed: {result['error']}")
+            return result
+
+        started = time.perf_counter()
+        with self._channels(connections) as channel:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                files = list(executor.map(transfer, pairs))
+        if direction == "upload":
+            for result in files:
+                self._listings.invalidate(result["destination"])
+
+        report = {
+            "succeeded": sum(1 for result in files if result["ok"]),
+            "failed": sum(1 for result in files if not result["ok"]),
+            "bytes": sum(result.get("bytes", 0) for result in files if result["ok"]),
+            "seconds": time.perf_counter() - started,
+            "files": files,
+        }
+        log.info(
+            f"Transfer done: {report['succeeded']} succeeded, {report['failed']} failed, "
+            f"{report['bytes']} bytes in {report['seconds']:.2f}s"
+        )
+        return report
+
+    def _channel_for(self, manager):
+        """Open one more SFTP channel on manager, logging it in again if it dropped"""
+        with self._login_lock:
+            transport = manager.client.get_transport() if manager.client else None
+            if transport is None or not transport.is_active():
+                log.warning("SSH connection lost, logging in again...")
+                if not manager.login():
+                    raise ConnectionError(f"Unable to reconnect to the host: {self.sftp_host}")
+        return manager.client.open_sftp()
+
+    @staticmethod
+    def _load_state(state_path, expected):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if any(state.get(key) != value for key, value in expected.items()):
+            log.info(f"Stale transfer state {state_path}, starting over")
+            return None
+        return state
+
+    @staticmethod
+    def _save_state(state_path, state):
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    @staticmethod
+    def _sha256(fileobj, chunk_size):
+        digest = hashlib.sha256()
+        for data in iter(lambda: fileobj.read(chunk_size), b""):
+            digest.update(data)
+        return digest.digest()
+
+    def _remote_sha256(self, sftp, remote_path, chunk_size):
+        with sftp.open(remote_path, "rb") as f:
+            try:
+                # "check-file" extension, hashed on the server side
+                return f.check("sha256")
+            except IOError:
+                log.info("Server can't hash files, reading the remote file back to verify it")
+            f.prefetch()
+            return self._sha256(f, chunk_size)
+
+    def _transfer_parts(self, state, state_path, transfer_part, connections, retries):
+        """Run transfer_part(sftp, part, checkpoint) for each unfinished part, in parallel"""
+        managers = [self]
+        for _ in range(max(connections, 1) - 1):
+            manager = self._clone()
+            if manager is None:
+                log.warning("Extra SSH connection failed, going on with fewer connections")
+                break
+            managers.append(manager)
+        state_lock = threading.Lock()
+
+        def checkpoint(part, done):
+            with state_lock:
+                part[2] = done
+                self._save_state(state_path, state)
+
+        def run(index, part):
+            manager = managers[index % len(managers)]
+            for attempt in range(retries + 1):
+                sftp = None
+                try:
+                    sftp = self._channel_for(manager)
+                    transfer_part(sftp, part, checkpoint)
+                    return
+                except Exception as e:
+                    if isinstance(e, (FileNotFoundError, PermissionError)) or attempt == retries:
+                        raise
+                    log.warning(
+                        f"Part {part[0]}-{part[1]} broke at offset {part[0] + part[2]} "
+                        f"({type(e).__name__}: {e}), resuming..."
+                    )
+                    time.sleep(2**attempt)
+                finally:
+                    if sftp is not None:
+                        try:
+                            sftp.close()
+                        except Exception as e:
+                            log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
+
+        pending = [part for part in state["parts"] if part[0] + part[2] < part[1]]
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+                for future in [executor.submit(run, *item) for item in enumerate(pending)]:
+                    future.result()
         finally:
-            sftp.close()
+            for manager in managers[1:]:
+                manager.logout()
+
+    def upload_large(
+        self,
+        source_path,
+        destination_path,
+        parts=4,
+        connections=1,
+        chunk_size=1024 * 1024,
+        checkpoint_size=16 * 1024 * 1024,
+        verify="size",
+        resume=True,
+        retries=3,
+    ):
+        """
+        Upload a big file in parts byte ranges, each written with pipelined
+        requests on its own SFTP channel (spread over connections SSH
+        connections). The confirmed offset of every part is kept in
+        "<source_path>.sftp-state", so a broken part, or a later call with
+        resume=True, carries on from there instead of from zero.
+        verify can be "size", "sha256" or None.
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+
+        state_path = source_path + STATE_SUFFIX
+        try:
+            file_stat = os.stat(source_path)
+            expected = {
+                "direction": "upload",
+                "remote": destination_path,
+                "size": file_stat.st_size,
+                "mtime": file_stat.st_mtime,
+            }
+            state = self._load_state(state_path, expected) if resume else None
+            if state is not None:
+                log.info(f"Resuming upload of {source_path}")
+            else:
+                state = dict(expected, parts=split_ranges(file_stat.st_size, parts, chunk_size))
+                self._run(lambda sftp: sftp.open(destination_path, "wb").close())
+                self._listings.invalidate(destination_path)
+                self._save_state(state_path, state)
+
+            def upload_part(sftp, part, checkpoint):
+                start, end, done = part
+                position = start + done
+                unconfirmed = 0
+                with open(source_path, "rb") as source, sftp.open(
+                    destination_path, "r+b", bufsize=0
+                ) as target:
+                    source.seek(position)
+                    target.seek(position)
+                    target.set_pipelined(True)
+                    while position < end:
+                        data = source.read(min(chunk_size, end - position))
+                        if not data:
+                            raise IOError(f"{source_path} changed during the upload")
+                        unconfirmed += len(data)
+                        confirm = unconfirmed >= checkpoint_size or position + len(data) >= end
+                        if confirm:
+                            write_confirmed(target, data)
+                        else:
+                            target.write(data)
+                        position += len(data)
+                        if confirm:
+                            checkpoint(part, position - start)
+                            unconfirmed = 0
+
+            started = time.perf_counter()
+            self._transfer_parts(state, state_path, upload_part, connections, retries)
+            seconds = time.perf_counter() - started
+            self._listings.invalidate(destination_path)
+
+            remote_size = self._run(lambda sftp: sftp.stat(destination_path).st_size)
+            if remote_size != file_stat.st_size:
+                log.error(f"Size mismatch after upload: {remote_size} != {file_stat.st_size}")
+                os.remove(state_path)
+                return False
+            if verify == "sha256":
+                with open(source_path, "rb") as f:
+                    local_hash = self._sha256(f, chunk_size)
+                remote_hash = self._run(
+                    lambda sftp: self._remote_sha256(sftp, destination_path, chunk_size)
+                )
+                if local_hash != remote_hash:
+                    log.error(f"Checksum mismatch after upload of {source_path}")
+                    os.remove(state_path)
+                    return False
+
+            os.remove(state_path)
+            log.info(
+                f"File exported from {source_path} to {destination_path} "
+                f"({file_stat.st_size} bytes in {seconds:.2f}s)"
+            )
+            return True
+        except Exception as e:
+            log.error(f"Error exporting file: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+
+    def download_large(
+        self,
+        source_path,
+        destination_path,
+        parts=4,
+        connections=1,
+        chunk_size=1024 * 1024,
+        checkpoint_size=16 * 1024 * 1024,
+        verify="size",
+        resume=True,
+        retries=3,
+    ):
+        """
+        Download a big file in parts byte ranges, each read with prefetched
+        requests on its own SFTP channel, into "<destination_path>.part".
+        The confirmed offsets are kept in "<destination_path>.sftp-state"
+        for resuming; the file is renamed in place once verified.
+        verify can be "size", "sha256" or None.
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+
+        state_path = destination_path + STATE_SUFFIX
+        part_path = destination_path + ".part"
+        try:
+            file_stat = self._run(lambda sftp: sftp.stat(source_path))
+            expected = {
+                "direction": "download",
+                "remote": source_path,
+                "size": file_stat.st_size,
+                "mtime": file_stat.st_mtime,
+            }
+            state = None
+            if resume and os.path.exists(part_path):
+                state = self._load_state(state_path, expected)
+            if state is not None:
+                log.info(f"Resuming download of {source_path}")
+            else:
+                state = dict(expected, parts=split_ranges(file_stat.st_size, parts, chunk_size))
+                with open(part_path, "wb") as f:
+                    f.truncate(file_stat.st_size)
+                self._save_state(state_path, state)
+
+            def download_part(sftp, part, checkpoint):
+                start, end, done = part
+                position = start + done
+                unsynced = 0
+                with sftp.open(source_path, "rb") as source, open(part_path, "r+b") as target:
+                    source.seek(position)
+                    # read ahead with concurrent requests, up to the end of the part
+                    source.prefetch(end)
+                    target.seek(position)
+                    while position < end:
+                        data = source.read(min(chunk_size, end - position))
+                        if not data:
+                            raise IOError(f"{source_path} changed during the download")
+                        target.write(data)
+                        position += len(data)
+                        unsynced += len(data)
+                        if unsynced >= checkpoint_size or position >= end:
+                            target.flush()
+                            os.fsync(target.fileno())
+                            checkpoint(part, position - start)
+                            unsynced = 0
+
+            started = time.perf_counter()
+            self._transfer_parts(state, state_path, download_part, connections, retries)
+            seconds = time.perf_counter() - started
+
+            # the .part file was pre-sized, so check what was read instead of its size
+            missing = sum(end - start - done for start, end, done in state["parts"])
+            if missing:
+                log.error(f"Download of {source_path} is missing {missing} bytes")
+                os.remove(state_path)
+                return False
+            remote_stat = self._run(lambda sftp: sftp.stat(source_path))
+            if (remote_stat.st_size, remote_stat.st_mtime) != (
+                file_stat.st_size,
+                file_stat.st_mtime,
+            ):
+                log.error(f"{source_path} changed during the download")
+                os.remove(state_path)
+                return False
+            if verify == "sha256":
+                with open(part_path, "rb") as f:
+                    local_hash = self._sha256(f, chunk_size)
+                remote_hash = self._run(
+                    lambda sftp: self._remote_sha256(sftp, source_path, chunk_size)
+                )
+                if local_hash != remote_hash:
+                    log.error(f"Checksum mismatch after download of {source_path}")
+                    os.remove(state_path)
+                    return False
+
+            os.replace(part_path, destination_path)
+            os.remove(state_path)
+            log.info(
+                f"File imported from {source_path} to {destination_path} "
+                f"({file_stat.st_size} bytes in {seconds:.2f}s)"
+            )
+            return True
+        except Exception as e:
+            log.error(f"Error importing file: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+
+    @staticmethod
+    def _write_chunks(f, chunks, chunk_size):
+        """Pipelined writes of chunks coalesced to chunk_size, returns the bytes written"""
+        f.set_pipelined(True)
+        buffer = bytearray()
+        # full chunk held back, so the stream always ends with a confirmed
+        # write even when its length is a multiple of chunk_size: paramiko
+        # drops the answers to pipelined writes that nobody waits for
+        pending = None
+        written = 0
+        for data in chunks:
+            buffer += data
+            if len(buffer) >= chunk_size:
+                if pending is not None:
+                    f.write(pending)
+                pending = bytes(buffer)
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            if pending is not None:
+                f.write(pending)
+            pending = bytes(buffer)
+            written += len(buffer)
+        if pending is not None:
+            write_confirmed(f, pending)
+        return written
+
+    def upload_stream(self, source, destination_path, compress=None, chunk_size=1024 * 1024):
+        """
+        Upload from a file-like object or an iterable of byte (or str) chunks,
+        without a local file. compress can be None, "gzip" or "zstd".
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+
+        try:
+            chunks = compress_chunks(iter_source(source, chunk_size), compress)
+            with self.session() as sftp, sftp.open(destination_path, "wb", bufsize=0) as f:
+                written = self._write_chunks(f, chunks, chunk_size)
+            self._listings.invalidate(destination_path)
+            log.info(f"Stream exported to {destination_path} ({written} bytes)")
+            return True
+        except Exception as e:
+            log.error(f"Error exporting stream: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+
+    def iter_download(
+        self, source_path, decompress=None, chunk_size=1024 * 1024, window=16 * 1024 * 1024
+    ):
+        """
+        Generator of the chunks of a remote file, read ahead with prefetched
+        requests. decompress can be None, "gzip" or "zstd". At most window
+        bytes are requested ahead of the consumer, so a slow consumer holds
+        about window bytes in memory, not the whole file. Errors are raised.
+        """
+        if self.client is None:
+            raise ConnectionError("SFTP Not connected.")
+
+        with self.session() as sftp:
+            size = sftp.stat(source_path).st_size
+
+            def windows():
+                position = 0
+                while True:
+                    end = min(position + window, size)
+                    # paramiko keeps prefetched answers until they are read, or
+                    # forever if it falls back to plain reads: one handle per window
+                    # so closing it frees them
+                    with sftp.open(source_path, "rb") as f:
+                        f.seek(position)
+                        if position == end:
+                            # anything appended since the stat
+                            yield from iter(lambda: f.read(chunk_size), b"")
+                            return
+                        f.prefetch(end)
+                        while position < end:
+                            data = f.read(min(chunk_size, end - position))
+                            if not data:
+                                return
+                            position += len(data)
+                            yield data
+
+            for data in decompress_chunks(windows(), decompress):
+                if data:
+                    yield data
+
+    def download_to(self, source_path, buffer, decompress=None, chunk_size=1024 * 1024):
+        """Download into buffer, any object with a write(bytes) method"""
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+
+        try:
+            written = 0
+            for data in self.iter_download(source_path, decompress, chunk_size):
+                buffer.write(data)
+                written += len(data)
+            log.info(f"File {source_path} streamed ({written} bytes)")
+            return True
+        except Exception as e:
+            log.error(f"Error importing file: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+
+    def _listdir_attr(self, sftp, remote_path, refresh=False):
+        if not refresh:
+            listing = self._listings.get(remote_path)
+            if listing is not None:
+                return listing
+        return self._listings.put(remote_path, sftp.listdir_attr(remote_path))
+
+    def listdir_attr(self, remote_path, refresh=False):
+        """Attributes of the entries of remote_path, from the listing cache when fresh"""
+        return list(self._run(lambda sftp: self._listdir_attr(sftp, remote_path, refresh)).values())
+
+    def stat(self, remote_path, refresh=False):
+        """
+        Attributes of remote_path, or None if it does not exist. Answered from
+        the cached listing of its parent, which is listed once on a miss, so
+        checking many files of one directory costs a single round trip.
+        """
+        parent, name = posixpath.split(remote_path.rstrip("/"))
+        if not name:
+            return self._run(lambda sftp: sftp.stat(remote_path))
+        try:
+            listing = self._run(lambda sftp: self._listdir_attr(sftp, parent or "/", refresh))
+        except FileNotFoundError:
+            return None
+        return listing.get(name)
+
+    def exists(self, remote_path, refresh=False):
+        return self.stat(remote_path, refresh) is not None
+
+    def _walk(self, remote_path, workers, connections, refresh, strict=False):
+        remote_path = remote_path.rstrip("/") or "/"
+        entries = []
+        with self._channels(connections) as channel:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+
+                def listing(path):
+                    return self._listdir_attr(channel(), path, refresh)
+
+                pending = {executor.submit(listing, remote_path): remote_path}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path = pending.pop(future)
+                        try:
+                            attrs = future.result().values()
+                        except Exception as e:
+                            if path == remote_path:
+                                raise
+                            if strict:
+                                for queued in pending:
+                                    queued.cancel()
+                                # not a FileNotFoundError: only the root may be missing
+                                raise OSError(f"Unable to list {path}: {e}") from e
+                            log.warning(f"Skipping {path}: {type(e).__name__}: {e}")
+                            continue
+                        for attr in attrs:
+                            child = posixpath.join(path, attr.filename)
+                            entries.append((child, attr))
+                            if stat.S_ISDIR(attr.st_mode):
+                                pending[executor.submit(listing, child)] = child
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def walk(self, remote_path, workers=8, connections=1, refresh=False):
+        """
+        List the whole tree under remote_path, directories being listed
+        concurrently by workers threads with their own SFTP channels.
+        Returns a sorted list of (path, attributes), or None on error;
+        unreadable subdirectories are logged and skipped.
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return
+
+        try:
+            started = time.perf_counter()
+            entries = self._walk(remote_path, workers, connections, refresh)
+            log.info(
+                f"Walked {remote_path}: {len(entries)} entries "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+            return entries
+        except Exception as e:
+            log.info(f"Error walking {remote_path}: {e}")
+
+    def _remote_tree(self, remote_dir, workers=8):
+        """({relative path: attributes} of regular files, set of relative dirs) under remote_dir"""
+        files, dirs = {}, set()
+        try:
+            # a partial tree would make sync_dir upload and mkdir what already exists
+            entries = self._walk(remote_dir, workers, 1, refresh=True, strict=True)
+        except FileNotFoundError:
+            return files, dirs
+        prefix = remote_dir.rstrip("/") + "/"
+        for path, attr in entries:
+            relative = path[len(prefix):]
+            if stat.S_ISDIR(attr.st_mode):
+                dirs.add(relative)
+            elif stat.S_ISREG(attr.st_mode):
+                files[relative] = attr
+        return files, dirs
+
+    @staticmethod
+    def _local_tree(local_dir):
+        files, dirs = {}, set()
+        for root, dirnames, filenames in os.walk(local_dir):
+            relative = os.path.relpath(root, local_dir)
+            relative = "" if relative == "." else relative.replace(os.sep, "/")
+            for name in dirnames:
+                dirs.add(posixpath.join(relative, name) if relative else name)
+            for name in filenames:
+                path = os.path.join(root, name)
+                if os.path.isfile(path):
+                    files[posixpath.join(relative, name) if relative else name] = os.stat(path)
+        return files, dirs
+
+    def sync_dir(
+        self,
+        local_dir,
+        remote_dir,
+        delete=False,
+        dry_run=False,
+        workers=4,
+        connections=1,
+        mtime_tolerance=1,
+    ):
+        """
+        Make remote_dir a copy of local_dir, uploading only the files that are
+        new or whose size or mtime changed (one listdir_attr per remote
+        directory). Uploaded files get the local mtime, so the next run skips
+        them. With delete=True files and directories missing locally are
+        removed from the remote side. With dry_run=True nothing is changed.
+        Returns the plan dict (upload, mkdir, delete, delete_dirs, unchanged),
+        with the transfer_many report under "report" when it ran.
+        """
+        if self.client is None:
+            log.info("SFTP Not connected.")
+            return False
+
+        try:
+            local_files, local_dirs = self._local_tree(local_dir)
+            remote_files, remote_dirs = self._remote_tree(remote_dir, workers)
+        except Exception as e:
+            log.error(f"Error reading the trees to sync: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+
+        upload, unchanged = [], 0
+        for relative, local_stat in sorted(local_files.items()):
+            attr = remote_files.get(relative)
+            if (
+                attr is None
+                or attr.st_size != local_stat.st_size
+                or abs(attr.st_mtime - int(local_stat.st_mtime)) > mtime_tolerance
+            ):
+                upload.append(relative)
+            else:
+                unchanged += 1
+        plan = {
+            "upload": upload,
+            "mkdir": sorted(local_dirs - remote_dirs, key=lambda d: (d.count("/"), d)),
+            "delete": sorted(set(remote_files) - set(local_files)) if delete else [],
+            # deepest first, so directories are empty when their turn comes
+            "delete_dirs": (
+                sorted(remote_dirs - local_dirs, key=lambda d: (-d.count("/"), d))
+                if delete
+                else []
+            ),
+            "unchanged": unchanged,
+        }
+        log.info(
+            f"Sync plan {local_dir} -> {remote_dir}: {len(plan['upload'])} to upload, "
+            f"{len(plan['mkdir'])} dirs to create, {len(plan['delete'])} files and "
+            f"{len(plan['delete_dirs'])} dirs to delete, {unchanged} unchanged"
+        )
+        if dry_run:
+            return plan
+
+        def remote(relative):
+            return posixpath.join(remote_dir, relative)
+
+        def ensure_dir(sftp, path):
+            try:
+                sftp.stat(path)
+            except FileNotFoundError:
+                sftp.mkdir(path)
+                self._listings.invalidate(path)
+
+        try:
+            if not remote_dirs and not remote_files:
+                self._run(lambda sftp: ensure_dir(sftp, remote_dir))
+            for relative in plan["mkdir"]:
+                self._run(lambda sftp: sftp.mkdir(remote(relative)))
+                self._listings.invalidate(remote(relative))
+            if upload:
+                plan["report"] = self.transfer_many(
+                    [
+                        (os.path.join(local_dir, *relative.split("/")), remote(relative))
+                        for relative in upload
+                    ],
+                    connections=connections,
+                    workers=workers,
+                    preserve_mtime=True,
+                )
+            for relative in plan["delete"]:
+                self._run(lambda sftp: sftp.remove(remote(relative)))
+                self._listings.invalidate(remote(relative))
+            for relative in plan["delete_dirs"]:
+                self._run(lambda sftp: sftp.rmdir(remote(relative)))
+                self._listings.invalidate(remote(relative))
+        except Exception as e:
+            log.error(f"Error syncing {local_dir} to {remote_dir}: {e}")
+            log.exception(ERR_TEMPLATE.format(type(e).__name__, e.args))
+            return False
+        return plan
 
     def list_files(self, remote_path):
         if self.client is None:
             log.info("SFTP Not connected.")
             return
 
-        sftp = self.client.open_sftp()
         try:
-            file_list = sftp.listdir(remote_path)
+            file_list = [attr.filename for attr in self.listdir_attr(remote_path)]
             log.info(f"Files in remote directory: {file_list}")
+            return file_list
         except Exception as e:
             log.info(f"Error listing files: {e}")
-        finally:
-            sftp.close()
 
     # function not used, only for testing purpose
     def delete_file(self, remote_path):
@@ -119,14 +1107,12 @@ class SFTPConnectionManager:
             log.info("SFTP Not connected.")
             return
 
-        sftp = self.client.open_sftp()
         try:
-            sftp.remove(remote_path)
+            self._run(lambda sftp: sftp.remove(remote_path))
+            self._listings.invalidate(remote_path)
             log.info(f"File deleted: {remote_path}")
         except Exception as e:
             log.info(f"Error deleting file: {e}")
-        finally:
-            sftp.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+from tinydb_conn import AppDbClient
+
+
+def reopen(path, table, **kwargs):
+    client = AppDbClient(path, **kwargs)
+    client.use_table(table)
+    return client
+
+
+def test_buffered_shards_keep_records_when_switching_tables(tmp_path):
+    path = str(tmp_path / "app.json")
+    client = AppDbClient(path, buffered=True, shard_tables=True)
+    client.use_table("a")
+    assert client.insert({"id": 1}) == 1
+    client.use_table("b")
+    client.insert({"id": 2})
+    client.use_table("a")
+    assert client.insert({"id": 3}) == 2
+    client.close()
+
+    client = reopen(path, "a", shard_tables=True)
+    assert sorted(doc["id"] for doc in client.table.all()) == [1, 3]
+    client.close()
+
+
+def test_use_table_reuses_the_open_shard(tmp_path):
+    client = AppDbClient(str(tmp_path / "app.json"), shard_tables=True)
+    client.use_table("a")
+    db = client.db
+    client.use_table("b")
+    client.use_table("a")
+    assert client.db is db
+    client.close()
+
+
+def test_drop_table_keeps_buffered_writes(tmp_path):
+    path = str(tmp_path / "app.json")
+    client = AppDbClient(path, buffered=True)
+    client.use_table("users")
+    client.insert({"id": 1})
+    client.drop_table("other")
+    client.close()
+
+    client = reopen(path, "users")
+    assert client.get_by("id", 1)
+    client.close()
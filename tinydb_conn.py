@@ -1,11 +1,36 @@
-
 from tinydb import TinyDB, Query
+from tinydb.storages import Storage, JSONStorage
+from tinydb.middlewares import CachingMiddleware
 from functools import wraps
+from contextlib import contextmanager
+import os
+import fcntl
+import mmap
+import json
+import time
+import struct
 import logging
 
+try:
+    import msgpack
+except ImportError:
+    # LogStorage falls back to compact JSON records
+    msgpack = None
+
 log = logging.getLogger(__name__)
 ERR_TEMPLATE = "An exception of type {0} occurred. Arguments: {1!r}"
 
+LOG_MAGIC = b"TDBLOG1"
+# magic, codec byte ("m" msgpack, "j" json), newline
+LOG_HEADER_SIZE = len(LOG_MAGIC) + 2
+RECORD_LENGTH = struct.Struct("!I")
+# per record version kept by AppDbClient(concurrent=True)
+VERSION_FIELD = "_version"
+
+
+class VersionConflictError(Exception):
+    """The record changed since the version the caller read"""
+
 
 def require_table_selected(func):
     @wraps(func)
@@ -20,35 +45,768 @@ def require_table_selected(func):
     return wrapper
 
 
+def synchronized(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.concurrent:
+            return func(self, *args, **kwargs)
+        with self._locked():
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class AtomicJSONStorage(Storage):
+    """JSON storage writing to a temporary file swapped in with os.replace"""
+
+    def __init__(self, path, encoding="utf-8", **kwargs):
+        self._path = path
+        self._encoding = encoding
+        # passed to json.dump, e.g. indent
+        self._kwargs = kwargs
+
+    def read(self):
+        try:
+            with open(self._path, encoding=self._encoding) as handle:
+                content = handle.read()
+        except FileNotFoundError:
+            return None
+        if not content.strip():
+            return None
+        return json.loads(content)
+
+    def write(self, data):
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding=self._encoding) as handle:
+            json.dump(data, handle, **self._kwargs)
+            handle.flush()
+            os.fsync(handle.fileno())
+        # readers see either the old or the new file, never a partial one
+        os.replace(tmp_path, self._path)
+
+    def close(self):
+        pass
+
+
+class BufferedMiddleware(CachingMiddleware):
+    """
+    Keep the database in memory and write it to the storage after
+    write_count changes, after flush_interval seconds since the last
+    flush (checked on each write), on flush() or on close()
+    """
+
+    def __init__(self, storage_cls, write_count=1000, flush_interval=None):
+        super().__init__(storage_cls)
+        self.WRITE_CACHE_SIZE = write_count
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+    def write(self, data):
+        super().write(data)
+        if (
+            self.flush_interval is not None
+            and self._cache_modified_count
+            and time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._cache_modified_count:
+            log.debug(f"Flushing {self._cache_modified_count} buffered writes")
+        super().flush()
+        self._last_flush = time.monotonic()
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data):
+    return json.loads(bytes(data))
+
+
+def _doc_id_order(doc_id):
+    # tinydb doc ids are str(int), keep them in insertion order in the log
+    return (0, int(doc_id), "") if str(doc_id).isdigit() else (1, 0, str(doc_id))
+
+
+class _TrackedDocument(dict):
+    """Stored document that reports in-place changes to its LogStorage"""
+
+    __slots__ = ("_key", "_changed")
+
+    def __init__(self, document, key, changed):
+        super().__init__(document)
+        self._key = key
+        self._changed = changed
+
+    def _touch(self):
+        changed = getattr(self, "_changed", None)
+        if changed is not None:
+            changed.add(self._key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touch()
+
+    def __ior__(self, other):
+        self._touch()
+        return super().__ior__(other)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._touch()
+
+    def pop(self, *args):
+        self._touch()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._touch()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._touch()
+        return super().setdefault(key, default)
+
+    def clear(self):
+        super().clear()
+        self._touch()
+
+
+class LogStorage(Storage):
+    """
+    Append-only log storage: a header followed by length-prefixed records
+    ["s", table, doc_id, doc] (set), ["d", table, doc_id, None] (delete),
+    ["t", table, None, None] (create table) and ["x", table, None, None]
+    (drop table), encoded with msgpack or, if it's not installed, JSON.
+
+    The file is replayed through mmap on open and only the new tail is
+    read afterwards. TinyDB passes the whole database to read() and
+    write(), so instead of copying and diffing it on every operation,
+    read() hands out the stored documents themselves, which record their
+    in-place changes, and write() appends records for those documents
+    plus the doc ids added or removed. Like CachingMiddleware, changes
+    made inside nested values of a document (a list appended to, ...)
+    are not seen until the field itself is set again.
+    Once the log holds more than compact_ratio records per live document
+    (and at least compact_min_records) it is rewritten atomically with
+    live data only.
+    """
+
+    def __init__(self, path, compact_ratio=2.0, compact_min_records=10000, sync=True):
+        self._path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.sync = sync
+        self._codec = b"m" if msgpack is not None else b"j"
+        self._dumps, self._loads = self._codec_functions(self._codec)
+        # table -> doc_id -> doc, as of the last record read or written
+        self._data = {}
+        # (table, doc_id) of the stored documents changed in place since the last write
+        self._changed = set()
+        self._records = 0
+        self._offset = 0
+        self._size = 0
+        self._inode = None
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self._create_file(path)
+        self._refresh()
+
+    @staticmethod
+    def _codec_functions(codec):
+        if codec == b"m":
+            if msgpack is None:
+                raise RuntimeError(
+                    "msgpack module is missing, you can install it by running # pip install msgpack"
+                )
+            return _msgpack_dumps, _msgpack_loads
+        if codec == b"j":
+            return _json_dumps, _json_loads
+        raise ValueError(f"Unknown log codec: {codec!r}")
+
+    def _header(self):
+        return LOG_MAGIC + self._codec + b"\n"
+
+    def _encode(self, record):
+        payload = self._dumps(record)
+        return RECORD_LENGTH.pack(len(payload)) + payload, payload
+
+    def _track(self, table, doc_id, doc):
+        return _TrackedDocument(doc, (table, doc_id), self._changed)
+
+    def _apply(self, record):
+        op, table, doc_id, doc = record
+        if op == "s":
+            self._data.setdefault(table, {})[doc_id] = self._track(table, doc_id, doc)
+        elif op == "d":
+            self._data.get(table, {}).pop(doc_id, None)
+        elif op == "t":
+            self._data.setdefault(table, {})
+        elif op == "x":
+            self._data.pop(table, None)
+
+    def _create_file(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            handle.write(self._header())
+        try:
+            # unlike os.replace, link fails if another process created it first
+            os.link(tmp_path, path)
+        except FileExistsError:
+            if os.path.getsize(path) == 0:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _refresh(self):
+        """Read the records appended since the last call"""
+        stat = os.stat(self._path)
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # first load, or the file was compacted in the meantime
+            self._data = {}
+            self._changed.clear()
+            self._records = 0
+            self._offset = 0
+            self._inode = stat.st_ino
+        if stat.st_size <= self._offset:
+            return
+
+        with open(self._path, "rb") as handle:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                if self._offset == 0:
+                    if view[: len(LOG_MAGIC)] != LOG_MAGIC:
+                        raise ValueError(f"{self._path} is not a log storage file")
+                    self._codec = view[len(LOG_MAGIC) : len(LOG_MAGIC) + 1]
+                    self._dumps, self._loads = self._codec_functions(self._codec)
+                    self._offset = LOG_HEADER_SIZE
+                size = len(view)
+                offset = self._offset
+                while offset + RECORD_LENGTH.size <= size:
+                    (length,) = RECORD_LENGTH.unpack_from(view, offset)
+                    end = offset + RECORD_LENGTH.size + length
+                    if end > size:
+                        break
+                    self._apply(self._loads(view[offset + RECORD_LENGTH.size : end]))
+                    self._records += 1
+                    offset = end
+                self._offset = offset
+                self._size = size
+
+    def read(self):
+        self._refresh()
+        if not self._data:
+            return None
+        # tinydb replaces whole tables in the dict it reads, never the ones inside
+        return dict(self._data)
+
+    def write(self, data):
+        self._refresh()
+        if self._size > self._offset:
+            # left by an interrupted append, records must follow a complete one
+            log.warning(f"Dropping incomplete record at the end of {self._path}")
+            os.truncate(self._path, self._offset)
+        records = [["x", table, None, None] for table in self._data if table not in data]
+        for table, docs in data.items():
+            current = self._data.get(table)
+            if current is docs:
+                continue
+            if current is None:
+                records.append(["t", table, None, None])
+                current = {}
+            # key set differences run in C, no per-document python work
+            added = docs.keys() - current.keys()
+            if len(current) + len(added) != len(docs):
+                removed = current.keys() - docs.keys()
+                records.extend(["d", table, doc_id, None] for doc_id in removed)
+            added = sorted(added, key=_doc_id_order)
+            records.extend(["s", table, doc_id, docs[doc_id]] for doc_id in added)
+        for table, doc_id in self._changed:
+            docs = data.get(table)
+            if docs is not None and doc_id in docs and doc_id in self._data.get(table, ()):
+                records.append(["s", table, doc_id, docs[doc_id]])
+        self._changed.clear()
+
+        # data becomes the snapshot, added documents are tracked from now on
+        self._data = dict(data)
+        for record in records:
+            if record[0] == "s" and not isinstance(record[3], _TrackedDocument):
+                self._data[record[1]][record[2]] = self._track(record[1], record[2], record[3])
+        if not records:
+            return
+
+        with open(self._path, "ab") as handle:
+            handle.write(b"".join(self._encode(record)[0] for record in records))
+            handle.flush()
+            if self.sync:
+                os.fsync(handle.fileno())
+            self._offset = self._size = handle.tell()
+        self._records += len(records)
+
+        live = sum(len(docs) + 1 for docs in self._data.values())
+        if self._records >= self.compact_min_records and self._records > self.compact_ratio * live:
+            self.compact()
+
+    def _write_file(self, path, records):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            handle.write(self._header())
+            for record in records:
+                handle.write(self._encode(record)[0])
+            handle.flush()
+            os.fsync(handle.fileno())
+            size = handle.tell()
+        os.replace(tmp_path, path)
+        return size
+
+    def _live_records(self):
+        for table, docs in self._data.items():
+            yield ["t", table, None, None]
+            for doc_id, doc in docs.items():
+                yield ["s", table, doc_id, doc]
+
+    def compact(self):
+        """Rewrite the log with one record per live table and document"""
+        log.debug(f"Compacting {self._path} ({self._records} records)")
+        self._refresh()
+        self._offset = self._size = self._write_file(self._path, self._live_records())
+        self._inode = os.stat(self._path).st_ino
+        self._records = sum(len(docs) + 1 for docs in self._data.values())
+
+    def close(self):
+        pass
+
+
+def convert_json_to_log(json_path, log_path, **kwargs):
+    """Copy a JSON (default tinydb) database into a new LogStorage file"""
+    if os.path.exists(log_path) and os.path.getsize(log_path) > 0:
+        raise FileExistsError(f"{log_path} already exists")
+    with open(json_path, encoding="utf-8") as handle:
+        content = handle.read()
+    data = json.loads(content) if content.strip() else {}
+    log.info(f"Converting {json_path} to log storage {log_path}")
+    storage = LogStorage(log_path, **kwargs)
+    storage.write(data)
+    storage.close()
+    return log_path
+
+
+# storage engines selectable from AppDbClient, (plain, buffered)
+STORAGES = {
+    "json": (JSONStorage, AtomicJSONStorage),
+    "log": (LogStorage, LogStorage),
+}
+
+
 class AppDbClient:
-    def __init__(self, db_name):
-        self.db = TinyDB(db_name)
+    def __init__(
+        self,
+        db_name,
+        buffered=False,
+        write_count=1000,
+        flush_interval=None,
+        indexes=None,
+        storage="json",
+        concurrent=False,
+        shard_tables=False,
+        **storage_kwargs,
+    ):
+        try:
+            self._storages = STORAGES[storage]
+        except KeyError:
+            raise ValueError(f"Storage can be only {list(STORAGES)}")
+
+        self._db_name = db_name
+        self._buffered = buffered
+        self._write_count = write_count
+        self._flush_interval = flush_interval
+        self._storage_kwargs = storage_kwargs
+        # file locking and per record versions for several processes
+        self.concurrent = concurrent
+        # one file per table, e.g. db.json -> db.<table>.json
+        self.shard_tables = shard_tables
+        # path -> TinyDB of every file opened so far
+        self._dbs = {}
+        if shard_tables:
+            # the shard is opened when a table is selected
+            self._db_path = None
+            self.db = None
+        else:
+            self._db_path = db_name
+            self.db = self._open_db(db_name)
         self.table = None
+        # fields with a hash index (e.g. ["id"]), built when a table is selected
+        self.indexed_fields = tuple(indexes or ())
+        # table name -> field -> value -> set of doc ids
+        self._indexes = {}
+        # path -> lock file handle, path -> file state seen when the lock was released
+        self._lock_handles = {}
+        self._signatures = {}
+        self._lock_depth = 0
+
+    def _open_db(self, path):
+        if self._buffered:
+            log.debug(
+                f"Opening {path} buffered, flush every {self._write_count} writes or {self._flush_interval}s"
+            )
+            middleware = BufferedMiddleware(self._storages[1], self._write_count, self._flush_interval)
+            db = TinyDB(path, storage=middleware, **self._storage_kwargs)
+        else:
+            db = TinyDB(path, storage=self._storages[0], **self._storage_kwargs)
+        self._dbs[path] = db
+        return db
+
+    def _get_db(self, path):
+        # not `or`: TinyDB's len() counts only the default table, so a db in use can be falsy
+        db = self._dbs.get(path)
+        if db is None:
+            db = self._open_db(path)
+        return db
+
+    def _shard_path(self, table_name):
+        root, ext = os.path.splitext(self._db_name)
+        return f"{root}.{table_name}{ext}"
 
     def use_table(self, table_name):
         log.debug("Selecting current table...")
+        if self.shard_tables:
+            self._db_path = self._shard_path(table_name)
+            self.db = self._get_db(self._db_path)
         self.table = self.db.table(table_name)
+        if self.concurrent:
+            # reloads the table and builds its indexes under the lock
+            with self._locked():
+                pass
+        elif self.indexed_fields and table_name not in self._indexes:
+            self._build_indexes()
+
+    @staticmethod
+    def _file_signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @contextmanager
+    def _locked(self, path=None):
+        """Hold an exclusive lock on the database file, nested calls share it"""
+        path = path or self._db_path
+        if self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+
+        handle = self._lock_handles.get(path)
+        if handle is None:
+            handle = self._lock_handles[path] = open(f"{path}.lock", "a")
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        self._lock_depth = 1
+        try:
+            self._sync_from_disk(path)
+            yield
+        finally:
+            try:
+                # other processes must see the changes once the lock is gone
+                self._flush_db(self._dbs[path])
+                self._signatures[path] = self._file_signature(path)
+            finally:
+                self._lock_depth = 0
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _sync_from_disk(self, path):
+        """Drop everything cached from the file, another process may have changed it"""
+        storage = self._dbs[path].storage
+        if isinstance(storage, CachingMiddleware):
+            storage.cache = None
+        if path != self._db_path or self.table is None:
+            return
+        self.table.clear_cache()
+        # tinydb caches the next doc id, it has to be read again
+        self.table._next_id = None
+        if not self.indexed_fields:
+            return
+        if (
+            self.table.name not in self._indexes
+            or self._file_signature(path) != self._signatures.get(path)
+        ):
+            self._build_indexes()
+
+    def _changes(self, update_data_dictionary):
+        """Fields to update, as a callable that also bumps the version in concurrent mode"""
+        if not self.concurrent:
+            return update_data_dictionary
+
+        def apply(document):
+            document.update(update_data_dictionary)
+            document[VERSION_FIELD] = document.get(VERSION_FIELD, 0) + 1
+
+        return apply
+
+    def _new_document(self, document):
+        if not self.concurrent:
+            return document
+        return {**document, VERSION_FIELD: 1}
+
+    def _build_indexes(self):
+        log.debug(f"Building indexes on {self.indexed_fields} for table {self.table.name}")
+        indexes = {field: {} for field in self.indexed_fields}
+        for document in self.table:
+            self._index_add(indexes, document.doc_id, document)
+        self._indexes[self.table.name] = indexes
+
+    @staticmethod
+    def _index_add(indexes, doc_id, document):
+        for field, index in indexes.items():
+            if field in document:
+                try:
+                    index.setdefault(document[field], set()).add(doc_id)
+                except TypeError:
+                    # unhashable values (lists, dicts) are not indexed
+                    pass
+
+    @staticmethod
+    def _index_remove(indexes, doc_id, document):
+        for field, index in indexes.items():
+            if field not in document:
+                continue
+            try:
+                doc_ids = index.get(document[field])
+            except TypeError:
+                continue
+            if doc_ids:
+                doc_ids.discard(doc_id)
+                if not doc_ids:
+                    del index[document[field]]
+
+    def _table_indexes(self):
+        return self._indexes.get(self.table.name)
+
+    def _lookup(self, field, value):
+        """Doc ids where field == value, None when the index can't answer"""
+        indexes = self._table_indexes()
+        if not indexes or field not in indexes:
+            return None
+        try:
+            return set(indexes[field].get(value, ()))
+        except TypeError:
+            return None
+
+    def _find_doc_ids(self, field, value):
+        doc_ids = self._lookup(field, value)
+        if doc_ids is None:
+            doc_ids = {document.doc_id for document in self.table.search(Query()[field] == value)}
+        return doc_ids
+
+    def _get_docs(self, doc_ids):
+        """Documents with the given ids, in doc id order, from a single table read"""
+        if not doc_ids:
+            return []
+        return self.table.get(doc_ids=list(doc_ids))
+
+    def _update_docs(self, doc_ids, update_data_dictionary):
+        changes = self._changes(update_data_dictionary)
+        indexes = self._table_indexes()
+        if not indexes or not any(field in update_data_dictionary for field in indexes):
+            return self.table.update(changes, doc_ids=list(doc_ids))
+
+        documents = self._get_docs(doc_ids)
+        for document in documents:
+            self._index_remove(indexes, document.doc_id, document)
+        updated = self.table.update(changes, doc_ids=list(doc_ids))
+        for document in documents:
+            self._index_add(indexes, document.doc_id, {**document, **update_data_dictionary})
+        return updated
+
+    @staticmethod
+    def _flush_db(db):
+        if isinstance(db.storage, CachingMiddleware):
+            db.storage.flush()
+
+    def flush(self):
+        """Write buffered changes to disk, no-op when not buffered"""
+        for db in self._dbs.values():
+            self._flush_db(db)
 
     def close(self):
         log.debug("Closing connection to database")
-        return self.db.close()
+        for db in self._dbs.values():
+            db.close()
+        for handle in self._lock_handles.values():
+            handle.close()
+        self._lock_handles = {}
 
     @require_table_selected
+    @synchronized
     def insert(self, dictionary_data):
         log.debug("Inserting new record in the table")
-        return self.table.insert(dictionary_data)
+        dictionary_data = self._new_document(dictionary_data)
+        doc_id = self.table.insert(dictionary_data)
+        indexes = self._table_indexes()
+        if indexes:
+            self._index_add(indexes, doc_id, dictionary_data)
+        return doc_id
+
+
+    @require_table_selected
+    @synchronized
+    def insert_many(self, documents):
+        """Insert an iterable of dicts with a single storage write, returns their doc ids"""
+        log.debug("Inserting records in bulk")
+        documents = (self._new_document(document) for document in documents)
+        indexes = self._table_indexes()
+        if not indexes:
+            return self.table.insert_multiple(documents)
+        documents = list(documents)
+        doc_ids = self.table.insert_multiple(documents)
+        for doc_id, document in zip(doc_ids, documents):
+            self._index_add(indexes, doc_id, document)
+        return doc_ids
+
+    @require_table_selected
+    @synchronized
+    def upsert_many(self, documents, key="id"):
+        """
+        Update the records whose key field matches one of documents and
+        insert the others. Existing keys come from the index on key, or from
+        one scan of the table. Updates are applied in one storage write and
+        inserts in another. Returns the doc id of each input document.
+        """
+        log.debug(f"Upserting records in bulk on {key}")
+        documents = list(documents)
+        indexes = self._table_indexes()
+        existing = None
+        if not indexes or key not in indexes:
+            existing = {}
+            for document in self.table:
+                if key in document:
+                    existing.setdefault(document[key], []).append(document.doc_id)
+
+        updates = {}
+        new_documents = []
+        # key value -> position in new_documents, so repeated keys are merged
+        pending = {}
+        targets = []
+        for document in documents:
+            if key not in document:
+                targets.append(("new", len(new_documents)))
+                new_documents.append(dict(document))
+                continue
+            value = document[key]
+            if existing is None:
+                doc_ids = sorted(self._lookup(key, value) or ())
+            else:
+                doc_ids = existing.get(value, ())
+            if doc_ids:
+                for doc_id in doc_ids:
+                    updates.setdefault(doc_id, {}).update(document)
+                targets.append(("doc", doc_ids[0]))
+            elif value in pending:
+                new_documents[pending[value]].update(document)
+                targets.append(("new", pending[value]))
+            else:
+                pending[value] = len(new_documents)
+                targets.append(("new", len(new_documents)))
+                new_documents.append(dict(document))
 
+        if updates:
+
+            def updater(table):
+                # the index is kept up to date here, where the table is already read
+                for doc_id, fields in updates.items():
+                    document = table[doc_id]
+                    if indexes:
+                        self._index_remove(indexes, doc_id, document)
+                    document.update(fields)
+                    if self.concurrent:
+                        document[VERSION_FIELD] = document.get(VERSION_FIELD, 0) + 1
+                    if indexes:
+                        self._index_add(indexes, doc_id, document)
+
+            # Table.update would take one pass per distinct set of fields
+            self.table._update_table(updater)
+
+        new_doc_ids = self.insert_many(new_documents) if new_documents else []
+        log.debug(f"Upsert done: {len(updates)} updated, {len(new_doc_ids)} inserted")
+        return [
+            new_doc_ids[position] if kind == "new" else position
+            for kind, position in targets
+        ]
 
     @require_table_selected
-    def update_data_sql_query(self, id, update_data_dictionary):
+    @synchronized
+    def update_data_sql_query(self, id, update_data_dictionary, expected_version=None):
+        """
+        Update the records with the given id. With expected_version the
+        update is refused with VersionConflictError if a record has been
+        changed since that version was read (see get_by).
+        """
         log.debug("Updating sql_query column in a table's record")
-        self.table.update(update_data_dictionary, Query().id == id)
+        if not self._table_indexes() and expected_version is None:
+            self.table.update(self._changes(update_data_dictionary), Query().id == id)
+            return
+        doc_ids = self._find_doc_ids("id", id)
+        if expected_version is not None:
+            for document in self._get_docs(doc_ids):
+                version = document.get(VERSION_FIELD, 0)
+                if version != expected_version:
+                    raise VersionConflictError(
+                        f"Record id={id} is at version {version}, expected {expected_version}"
+                    )
+        if doc_ids:
+            self._update_docs(doc_ids, update_data_dictionary)
+
+    @require_table_selected
+    @synchronized
+    def get_by(self, field, value):
+        """Records where field == value, through the index when field is indexed"""
+        doc_ids = self._lookup(field, value)
+        if doc_ids is None:
+            return self.table.search(Query()[field] == value)
+        return self._get_docs(doc_ids)
+
+    @require_table_selected
+    @synchronized
+    def remove_by(self, field, value):
+        """Remove the records where field == value, returns their doc ids"""
+        log.debug(f"Removing records with {field} == {value}")
+        doc_ids = self._find_doc_ids(field, value)
+        if not doc_ids:
+            return []
+        indexes = self._table_indexes()
+        if indexes:
+            for document in self._get_docs(doc_ids):
+                self._index_remove(indexes, document.doc_id, document)
+        return self.table.remove(doc_ids=list(doc_ids))
 
 
     @require_table_selected
     def drop_table(self, table):
         try:
             log.debug(f"Dropping table: {table}")
-            self.db.drop_table(table)
+            path = self._shard_path(table) if self.shard_tables else self._db_path
+            db = self._get_db(path)
+            if self.concurrent:
+                with self._locked(path):
+                    db.drop_table(table)
+            else:
+                db.drop_table(table)
+            self._indexes.pop(table, None)
         except Exception as e:
             log.debug(ERR_TEMPLATE.format(type(e).__name__, e.args))
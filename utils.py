@@ -4,7 +4,11 @@ __version__ = 2.0
 __status__ = "Production"
 
 import os
+import re
 import sys
+import math
+import array
+import threading
 import shutil
 import time
 import tty
@@ -12,8 +16,17 @@ import termios
 import logging
 import ipaddress
 import socket
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 
+try:
+    import numpy as np
+except ImportError:
+    # columns_from_cursor falls back to array.array / lists
+    np = None
+
 
 log = logging.getLogger()
 consoleHandler = logging.StreamHandler()
@@ -170,7 +183,372 @@ def getch():
     return ch
 
 
-def check_connection(sftp_host, sftp_port):
+def _extend_column(columns, index, values):
+    column = columns[index]
+    if isinstance(column, array.array):
+        size = len(column)
+        try:
+            if column.typecode == "d":
+                column.extend(math.nan if value is None else value for value in values)
+            else:
+                column.extend(values)
+            return
+        except (TypeError, OverflowError):
+            # NULL in an integer column or a value out of range:
+            # keep the column as plain python objects from now on
+            del column[size:]
+            column = columns[index] = column.tolist()
+    column.extend(values)
+
+
+def _column_to_numpy(column):
+    if isinstance(column, array.array):
+        dtype = np.float64 if column.typecode == "d" else np.int64
+        return np.frombuffer(column, dtype=dtype)
+    result = np.empty(len(column), dtype=object)
+    result[:] = column
+    return result
+
+
+def columns_from_cursor(cursor, typecodes=None, batch_size=10000, as_numpy=True):
+    """
+    Drain the cursor into a dict of column name -> column values.
+    typecodes maps the driver type_code of cursor.description to an
+    array.array typecode ("q" or "d"); those columns are packed in
+    arrays, the others kept as lists. Rows are read batch_size at a time.
+    With as_numpy (and numpy installed) every column becomes a numpy array.
+    """
+    if cursor.description is None:
+        return {}
+
+    typecodes = typecodes or {}
+    names = [column[0] for column in cursor.description]
+    columns = []
+    for column in cursor.description:
+        typecode = typecodes.get(column[1])
+        columns.append(array.array(typecode) if typecode else [])
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for index, values in enumerate(zip(*rows)):
+            _extend_column(columns, index, values)
+
+    if as_numpy and np is not None:
+        columns = [_column_to_numpy(column) for column in columns]
+    return dict(zip(names, columns))
+
+
+# regex -> replacement applied in order to turn a statement into its fingerprint
+FINGERPRINT_RULES = [
+    (re.compile(r"/\*.*?\*/", re.S), " "),
+    (re.compile(r"--[^\n]*"), " "),
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?+)"),
+    (re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+"), "(?+)"),
+]
+# statements longer than this are fingerprinted but not cached
+FINGERPRINT_CACHE_MAX_LEN = 4096
+
+
+@lru_cache(maxsize=1024)
+def _cached_fingerprint(sql):
+    return _fingerprint(sql)
+
+
+def _fingerprint(sql):
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip().lower()
+
+
+def sql_fingerprint(sql):
+    """
+    Normalize a statement so that the same query with different
+    values (literals, placeholders, IN lists, VALUES rows) gives the same key
+    """
+    if not isinstance(sql, str):
+        sql = str(sql)
+    if len(sql) > FINGERPRINT_CACHE_MAX_LEN:
+        return _fingerprint(sql)
+    return _cached_fingerprint(sql)
+
+
+def approx_rows_size(rows):
+    """Rough size in bytes of fetched rows: length of str/bytes cells, 8 for the others"""
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes, bytearray)):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+def _prometheus_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def truncate(text, max_chars):
+    """text cut to max_chars characters, with the length of what was dropped"""
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}...[{len(text) - max_chars} more chars]"
+
+
+class QueryStats:
+    """
+    In-process statement statistics: wall time histogram, rows and bytes
+    fetched per SQL fingerprint, plus a connection wait time histogram.
+    Statements slower than slow_query_threshold seconds are logged with
+    their params, both cut to log_max_chars characters.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # batched INSERTs can be megabytes long, only their head goes to the log
+    LOG_MAX_CHARS = 500
+
+    def __init__(
+        self, slow_query_threshold=None, buckets=None, enabled=True, log_max_chars=LOG_MAX_CHARS
+    ):
+        self.slow_query_threshold = slow_query_threshold
+        self.log_max_chars = log_max_chars
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def _new_histogram(self):
+        return {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+
+    def _observe(self, histogram, seconds):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+                break
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+            self._wait = self._new_histogram()
+
+    def _entry(self, fingerprint):
+        entry = self._queries.get(fingerprint)
+        if entry is None:
+            entry = self._queries[fingerprint] = {
+                "duration": self._new_histogram(),
+                "rows": 0,
+                "bytes": 0,
+            }
+        return entry
+
+    def record(self, sql, seconds, rows=0, params=None):
+        """Record one statement execution"""
+        if not self.enabled:
+            return
+        fingerprint = sql_fingerprint(sql)
+        with self._lock:
+            entry = self._entry(fingerprint)
+            self._observe(entry["duration"], seconds)
+            if rows and rows > 0:
+                entry["rows"] += rows
+        if self.slow_query_threshold is not None and seconds >= self.slow_query_threshold:
+            log.warning(
+                f"Slow query ({seconds:.3f}s): {truncate(sql, self.log_max_chars)}, "
+                f"params: {truncate(repr(params), self.log_max_chars)}"
+            )
+
+    def record_fetch(self, sql, rows):
+        """Add the approximate size of rows fetched for the statement sql"""
+        if not self.enabled or sql is None or not rows:
+            return
+        size = approx_rows_size(rows)
+        fingerprint = sql_fingerprint(sql)
+        with self._lock:
+            self._entry(fingerprint)["bytes"] += size
+
+    def record_wait(self, seconds):
+        """Record the time spent waiting for a connection"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._observe(self._wait, seconds)
+
+    def snapshot(self):
+        """Copy of the collected data, {"queries": {fingerprint: ...}, "connection_wait": ...}"""
+        with self._lock:
+            queries = {
+                fingerprint: {
+                    "duration": dict(entry["duration"], buckets=list(entry["duration"]["buckets"])),
+                    "rows": entry["rows"],
+                    "bytes": entry["bytes"],
+                }
+                for fingerprint, entry in self._queries.items()
+            }
+            wait = dict(self._wait, buckets=list(self._wait["buckets"]))
+        return {"queries": queries, "connection_wait": wait}
+
+    def _histogram_lines(self, name, histogram, labels=""):
+        lines = []
+        cumulative = 0
+        separator = "," if labels else ""
+        for bound, count in zip(self.buckets, histogram["buckets"]):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram["count"]}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram['sum']}")
+        lines.append(f"{name}_count{suffix} {histogram['count']}")
+        return lines
+
+    def to_prometheus(self):
+        """Render the snapshot in the Prometheus text exposition format"""
+        data = self.snapshot()
+        lines = [
+            "# HELP sql_query_duration_seconds Statement wall time by SQL fingerprint",
+            "# TYPE sql_query_duration_seconds histogram",
+        ]
+        for fingerprint, entry in data["queries"].items():
+            labels = f'fingerprint="{_prometheus_label(fingerprint)}"'
+            lines += self._histogram_lines("sql_query_duration_seconds", entry["duration"], labels)
+        for metric, key, text in (
+            ("sql_query_rows_total", "rows", "Rows returned or affected"),
+            ("sql_query_fetched_bytes_total", "bytes", "Approximate bytes fetched"),
+        ):
+            lines.append(f"# HELP {metric} {text} by SQL fingerprint")
+            lines.append(f"# TYPE {metric} counter")
+            for fingerprint, entry in data["queries"].items():
+                labels = f'fingerprint="{_prometheus_label(fingerprint)}"'
+                lines.append(f"{metric}{{{labels}}} {entry[key]}")
+        lines.append("# HELP sql_connection_wait_seconds Time spent waiting for a database connection")
+        lines.append("# TYPE sql_connection_wait_seconds histogram")
+        lines += self._histogram_lines("sql_connection_wait_seconds", data["connection_wait"])
+        return "\n".join(lines) + "\n"
+
+
+# shared by the database clients, e.g. QUERY_STATS.slow_query_threshold = 0.5
+QUERY_STATS = QueryStats()
+
+
+class DnsCache:
+    """
+    getaddrinfo results (IPv4 and IPv6) kept for ttl seconds; failed
+    lookups are kept for negative_ttl so a broken name is not retried
+    by every probe.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """[(family, sockaddr), ...] of host with port filled in, raises socket.gaierror"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(host)
+        if cached is None or cached[0] < now:
+            try:
+                infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+                addresses = []
+                for family, _, _, _, sockaddr in infos:
+                    if (family, sockaddr) not in addresses:
+                        addresses.append((family, sockaddr))
+                cached = (now + self.ttl, addresses)
+                log.debug(f"Dns resolved of host: {host} as {[a[1][0] for a in addresses]}")
+            except socket.gaierror as e:
+                cached = (now + self.negative_ttl, e)
+            with self._lock:
+                self._entries[host] = cached
+        if isinstance(cached[1], Exception):
+            raise cached[1]
+        return [(family, (sockaddr[0], port) + sockaddr[2:]) for family, sockaddr in cached[1]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+DNS_CACHE = DnsCache()
+
+
+def probe(host, port, timeout=3.0, dns_cache=DNS_CACHE):
+    """
+    Try a TCP connection to host:port, every resolved address in turn
+    within timeout seconds overall. Returns a dict with host, port, ok,
+    address, latency_ms (connect time) and error.
+    """
+    result = {"host": host, "port": port, "ok": False, "address": None, "latency_ms": None}
+    deadline = time.monotonic() + timeout
+    try:
+        addresses = dns_cache.resolve(host, port)
+    except socket.gaierror as e:
+        result["error"] = f"DNS resolution failed: {e}"
+        return result
+
+    for family, sockaddr in addresses:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result["error"] = "timed out"
+            break
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(remaining)
+            started = time.perf_counter()
+            sock.connect(sockaddr)
+            result.update(
+                ok=True,
+                address=sockaddr[0],
+                latency_ms=(time.perf_counter() - started) * 1000,
+                error=None,
+            )
+            break
+        except OSError as e:
+            result["error"] = "timed out" if isinstance(e, socket.timeout) else str(e)
+        finally:
+            sock.close()
+    return result
+
+
+def split_endpoint(endpoint):
+    """(host, port) from a (host, port) pair, "host:port" or "[ipv6]:port" """
+    if not isinstance(endpoint, str):
+        host, port = endpoint
+        return host, int(port)
+    host, _, port = endpoint.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def probe_endpoints(endpoints, timeout=3.0, workers=32, dns_cache=DNS_CACHE):
+    """
+    Probe many endpoints ((host, port) pairs or "host:port" strings)
+    concurrently. Returns the probe() results in input order.
+    """
+    endpoints = [split_endpoint(endpoint) for endpoint in endpoints]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(endpoints)))) as executor:
+        results = list(
+            executor.map(lambda endpoint: probe(*endpoint, timeout, dns_cache), endpoints)
+        )
+    failed = [f"{r['host']}:{r['port']} ({r['error']})" for r in results if not r["ok"]]
+    log.info(
+        f"Probed {len(results)} endpoints in {time.perf_counter() - started:.2f}s, "
+        f"{len(failed)} unreachable"
+    )
+    for endpoint in failed:
+        log.warning(f"Host or port not reachable: {endpoint}")
+    return results
+
+
+def check_connection(sftp_host, sftp_port, timeout=10):
     log.info("Checking sftp host and port connectivity...")
     try:
         ipaddress.ip_address(sftp_host)
@@ -179,7 +557,7 @@ def check_connection(sftp_host, sftp_port):
         if not check_dns_name(sftp_host):
             return False
 
-    if not check_ip_and_port(sftp_host, sftp_port):
+    if not check_ip_and_port(sftp_host, sftp_port, timeout):
         return False
 
     return True
@@ -187,25 +565,22 @@ def check_connection(sftp_host, sftp_port):
 
 def check_dns_name(host):
     try:
-        ip = socket.gethostbyname(host)
-        log.debug(f"Dns resolved of host: {host} as IP: {ip}")
+        DNS_CACHE.resolve(host, 0)
         return True
     except socket.gaierror:
         log.critical(f"DNS Resolution Failed of host: {host}")
         return False
 
 
-def check_ip_and_port(host, port):
+def check_ip_and_port(host, port, timeout=10):
     destination = (host, port)
-    create_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = (create_socket.connect_ex(destination),)
+    result = probe(host, port, timeout)
 
-    if not result == (0,):
-        log.critical(f"Host or port not reachable: {destination}")
-        create_socket.close()
+    if not result["ok"]:
+        log.critical(f"Host or port not reachable: {destination} ({result['error']})")
         return False
 
-    log.debug(f"Host or port reachable: {destination}")
+    log.debug(f"Host or port reachable: {destination} in {result['latency_ms']:.1f}ms")
 
     return True
 